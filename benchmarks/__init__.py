@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+""" Benchmarks module
+
+*codec* measures the encoding and decoding of data types and packets.
+
+*framing* measures the decoding of packets received in fragments, by a
+connection and by its FrameDecoder alone.
+
+*endtoend* measures the handshake, status and ping of concurrent clients
+with a server on loopback.
+
+Run with `python -m benchmarks`, results are written as JSON and can be
+compared with a baseline (see *__main__*).
+
+"""
+
+import timeit
+
+
+def result(value, unit, better="higher"):
+    """ Measured value, better says if higher or lower values are better. """
+    return {"value": value, "unit": unit, "better": better}
+
+
+def opsPerSecond(funct, min_time=0.2):
+    """ Returns the number of calls of funct per second. """
+    timer = timeit.Timer(funct)
+    number, _ = timer.autorange()
+    number = max(number, int(number * min_time / 0.2))
+    best = min(timer.repeat(3, number))
+    return result(number / best, "ops/s")
+
+
+def percentile(values, q):
+    """ Returns the q percentile (0 to 100) of sorted values. """
+    if not values:
+        return None
+    index = min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))
+    return values[index]
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+""" Runs the benchmarks and compares them with a baseline.
+
+python -m benchmarks [codec] [framing] [endtoend] --output results.json
+python -m benchmarks --baseline baseline.json  # Fails on regressions
+python -m benchmarks --save-baseline baseline.json
+"""
+
+import sys
+import json
+import argparse
+import platform
+
+from . import codec, framing, endtoend
+
+SUITES = {
+    "codec": codec.run,
+    "framing": framing.run,
+    "endtoend": endtoend.run
+}
+
+
+def compare(results, baseline, tolerance):
+    """ Returns the results worse than baseline by more than tolerance. """
+    regressions = []
+    for name, base in baseline.get("results", {}).items():
+        current = results.get(name)
+        if current is None or base["value"] is None \
+                or current["value"] is None:
+            continue
+        if base["better"] == "higher":
+            worse = current["value"] < base["value"] * (1 - tolerance)
+        else:
+            worse = current["value"] > base["value"] * (1 + tolerance)
+        if worse:
+            regressions.append((name, base["value"], current["value"],
+                                current["unit"]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks", description="Runs the benchmarks.")
+    parser.add_argument("suites", nargs="*",
+                        help="suites to run among %s, all by default"
+                             % ", ".join(SUITES))
+    parser.add_argument("--output", help="JSON file of the results")
+    parser.add_argument("--baseline", help="JSON results to compare with")
+    parser.add_argument("--save-baseline", help="writes the results there")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="relative slowdown tolerated (0.2 = 20%%)")
+    parser.add_argument("--clients", type=int, default=endtoend.CLIENTS,
+                        help="concurrent clients of endtoend")
+    parser.add_argument("--engine", choices=endtoend.ENGINES,
+                        help="server engine of endtoend, all by default")
+    args = parser.parse_args()
+    for name in args.suites:
+        if name not in SUITES:
+            parser.error("unknown suite: " + name)
+
+    results = {}
+    for name in args.suites or list(SUITES):
+        print("Running %s..." % name, file=sys.stderr)
+        if name == "endtoend":
+            for engine in [args.engine] if args.engine else endtoend.ENGINES:
+                results.update(endtoend.run(args.clients, engine=engine))
+        else:
+            results.update(SUITES[name]())
+
+    for name, r in sorted(results.items()):
+        print("%-40s %14.2f %s" % (name, r["value"] or 0, r["unit"]))
+
+    report = {"python": platform.python_version(),
+              "machine": platform.machine(),
+              "results": results}
+    for path in [args.output, args.save_baseline]:
+        if path:
+            with open(path, "w") as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for name, base, current, unit in regressions:
+            print("REGRESSION %s: %.2f -> %.2f %s"
+                  % (name, base, current, unit))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+import common
+import schema
+
+from . import opsPerSecond
+
+PAYLOAD_SIZES = [16, 1024, 65536]
+VARINTS = {"small": 1, "medium": 300000, "negative": -1}
+
+
+def fedBuffer(data):
+    buffer = common.ReceiveBuffer()
+    buffer.extend(data)
+    return buffer
+
+
+def decode(packet_schema, data):
+    buffer = fedBuffer(data)
+    return packet_schema.decode(buffer, len(data))
+
+
+def run():
+    results = {}
+
+    for name, value in VARINTS.items():
+        data = schema.writeVarInt(value, 1)
+        results["writeVarInt." + name] = opsPerSecond(
+            lambda: schema.writeVarInt(value, 1))
+        results["readVarInt." + name] = opsPerSecond(
+            lambda: schema.readVarInt(fedBuffer(data), 32))
+
+    string_schema = schema.compile((("String", 32767),))
+    for size in PAYLOAD_SIZES:
+        value = "x" * min(size, 32767)
+        data = schema.writeString(value)
+        results["writeString.%s" % size] = opsPerSecond(
+            lambda: schema.writeString(value))
+        results["readString.%s" % size] = opsPerSecond(
+            lambda: decode(string_schema, data))
+
+    # Handshake, pong and byte arrays.
+    packets = {
+        "handshake": ([("VarInt", -1), ("String", "localhost"),
+                       ("Unsigned Short", 23456), ("VarInt", 1)],
+                      ["VarInt", ("String", 255), "Unsigned Short", "VarInt"]),
+        "pong": ([("Long", 1234567890123)], ["Long"])
+    }
+    for size in PAYLOAD_SIZES:
+        packets["bytes.%s" % size] = ([("Byte Array", bytes(size))],
+                                      [("Byte Array", "left")])
+    for name in ["Long Array", "VarInt Array"]:
+        values = list(range(0, 1000000, 1000))
+        packets["%s.1000" % name.replace(" ", "")] = ([(name, values)],
+                                                      [name])
+
+    for name, (packet_data, types) in packets.items():
+        packet_schema = schema.compile(tuple(types))
+        body = common.encodeBody(0, packet_data)[1:]  # Without the id
+        results["pack." + name] = opsPerSecond(
+            lambda: common.encodePacket(0, packet_data))
+        results["unpack." + name] = opsPerSecond(
+            lambda: decode(packet_schema, body))
+
+    return results
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+import time
+import logging
+import threading
+import socket as sk
+
+import common
+import framing
+import server
+
+from . import result, percentile
+
+ENGINES = ("threads", "pool", "asyncio")
+CLIENTS = 50
+ITERATIONS = 20  # Handshake, status and ping of each client
+TIMEOUT = 10  # s
+
+
+def freePort():
+    with sk.socket(sk.AF_INET, sk.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def receivePacket(socket, decoder):
+    """ Returns the next (packet id, data) received by socket. """
+    packet = decoder.nextPacket()
+    while packet is None:
+        data = socket.recv(65536)
+        if not data:
+            raise common.NoDataError("Benchmark")
+        decoder.feed(data)
+        packet = decoder.nextPacket()
+    packet_id, data, _ = packet
+    return packet_id, bytes(data)
+
+
+def runClient(port, iterations, latencies, errors):
+    """ Handshake, status request and ping, iterations times. """
+    try:
+        socket = sk.create_connection(("127.0.0.1", port), TIMEOUT)
+        socket.setsockopt(sk.IPPROTO_TCP, sk.TCP_NODELAY, 1)
+    except OSError:
+        errors.append("connect")
+        return
+    decoder = framing.FrameDecoder()
+    try:
+        for i in range(iterations):
+            start = time.perf_counter()
+            socket.sendall(
+                common.encodePacket(0, [("VarInt", -1),
+                                        ("String", "127.0.0.1"),
+                                        ("Unsigned Short", port),
+                                        ("VarInt", 1)])
+                + common.encodePacket(0, [])
+                + common.encodePacket(1, [("Long", i)]))
+            received = [receivePacket(socket, decoder)[0] for _ in range(2)]
+            latencies.append(time.perf_counter() - start)
+            if received != [0, 1]:
+                errors.append("unexpected packets %s" % received)
+    except (OSError, common.NoDataError):
+        errors.append("connection")
+    finally:
+        socket.close()
+
+
+def runMalformedClient(port, errors):
+    """ Sends a malformed packet length, expects only itself closed. """
+    try:
+        socket = sk.create_connection(("127.0.0.1", port), TIMEOUT)
+    except OSError:
+        errors.append("connect")
+        return
+    try:
+        socket.sendall(b"\xff" * 6)  # VarInt longer than 5 bytes
+        if socket.recv(1):
+            errors.append("malformed packet answered")
+    except OSError:  # Reset by the server
+        pass
+    finally:
+        socket.close()
+
+
+def run(clients=CLIENTS, iterations=ITERATIONS, engine=None):
+    """ Runs the server in a thread and clients in threads. """
+    port = freePort()
+    server.server_ip = ("127.0.0.1", port)
+    server.max_clients = max(server.max_clients, clients)
+    server.backlog = max(server.backlog, clients)
+    if engine:
+        server.engine = engine
+
+    level = logging.getLogger().level
+    logging.getLogger().setLevel(logging.WARNING)
+    thread = threading.Thread(target=server.runEngine, name="Server")
+    thread.start()
+    try:
+        while not server.running:  # Waits for the server to listen.
+            time.sleep(0.01)
+        time.sleep(0.1)
+
+        latencies, errors = [], []
+        # The server has to keep serving the benchmark clients.
+        runMalformedClient(port, errors)
+        threads = [threading.Thread(target=runClient,
+                                    args=(port, iterations, latencies, errors))
+                   for _ in range(clients)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        server.running = False
+        if server.wakeup:
+            server.wakeup()
+        thread.join()
+        logging.getLogger().setLevel(level)
+
+    latencies = sorted(latency * 1000 for latency in latencies)
+    name = "endtoend.%s" % server.engine
+    return {
+        name + ".throughput": result(len(latencies) / elapsed, "status/s"),
+        name + ".p50": result(percentile(latencies, 50), "ms", "lower"),
+        name + ".p99": result(percentile(latencies, 99), "ms", "lower"),
+        name + ".p999": result(percentile(latencies, 99.9), "ms", "lower"),
+        name + ".errors": result(len(errors), "errors", "lower")
+    }
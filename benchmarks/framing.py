@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+import common
+import framing
+
+from . import opsPerSecond
+
+PACKETS = 100  # Packets of a stream
+PAYLOAD_SIZES = [16, 4096]
+
+
+class Connection(common.Connection):
+    """ Connection counting the packets handled. """
+
+    def __init__(self, size):
+        super().__init__(None, ("benchmark", 0))
+        self.handled = 0
+        self.running = True
+        table = common.PacketTable()
+        table.expect(0, [("Byte Array", size)], Connection.handle)
+        self.initState([table], False, [0])
+
+    def handle(self, data):
+        self.handled += 1
+
+
+def feedAll(size, chunks):
+    connection = Connection(size)
+    for chunk in chunks:
+        connection.feed(chunk)
+    assert connection.handled == PACKETS
+    return connection
+
+
+def decodeAll(chunks):
+    decoder = framing.FrameDecoder()
+    count = 0
+    for chunk in chunks:
+        decoder.feed(chunk)
+        while decoder.nextPacket() is not None:
+            count += 1
+    assert count == PACKETS
+
+
+def split(data, step):
+    return [data[i:i + step] for i in range(0, len(data), step)]
+
+
+def run():
+    results = {}
+
+    for size in PAYLOAD_SIZES:
+        frame = common.encodePacket(0, [("Byte Array", bytes(size))])
+        stream = frame * PACKETS
+
+        for name, chunks in [("whole", [stream]),
+                             ("1024", split(stream, 1024)),
+                             ("bytes", split(stream, 1))]:
+            result = opsPerSecond(lambda: feedAll(size, chunks))
+            result["value"] *= PACKETS  # Packets per second
+            result["unit"] = "packets/s"
+            results["feed.%s.%s" % (size, name)] = result
+
+            # The decoder alone, without handling the packets.
+            result = opsPerSecond(lambda: decodeAll(chunks))
+            result["value"] *= PACKETS
+            result["unit"] = "packets/s"
+            results["decoder.%s.%s" % (size, name)] = result
+
+        # Each packet split in two at every byte boundary.
+        boundaries = [[frame[:i], frame[i:]] * PACKETS
+                      for i in range(1, len(frame))]
+        if size <= 16:
+            def feedBoundaries():
+                for chunks in boundaries:
+                    feedAll(size, chunks)
+            result = opsPerSecond(feedBoundaries)
+            result["value"] *= PACKETS * len(boundaries)
+            result["unit"] = "packets/s"
+            results["feed.%s.boundaries" % size] = result
+
+    return results
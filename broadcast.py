@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+import logging
+
+from threading import Lock
+
+import common
+
+
+class Broadcaster:
+    """ Sends a packet to many connections, encoding it only once.
+
+    The frame is a single immutable bytes object queued to the send queue
+    of every recipient (one per compression threshold). Recipients can be
+    filtered by state or by named topics connections subscribe to.
+    """
+
+    def __init__(self):
+        self.topics = {}  # Topic name: set of connections
+        self.lock = Lock()
+
+    def subscribe(self, connection, topic):
+        with self.lock:
+            self.topics.setdefault(topic, set()).add(connection)
+            connection.topics = connection.topics | {topic}
+
+    def unsubscribe(self, connection, topic=None):
+        """ Removes connection from topic, or from every topic if None. """
+        with self.lock:
+            topics = [topic] if topic is not None else list(connection.topics)
+            for t in topics:
+                subscribers = self.topics.get(t)
+                if subscribers is not None:
+                    subscribers.discard(connection)
+                    if not subscribers:
+                        del self.topics[t]
+                connection.topics = connection.topics - {t}
+
+    def subscribers(self, topic):
+        with self.lock:
+            return list(self.topics.get(topic, ()))
+
+    def select(self, connections, state=None, topic=None):
+        """ Returns the running connections matching state and topic. """
+        if topic is not None:
+            subscribers = set(self.subscribers(topic))
+        return [c for c in connections if c.running
+                and (state is None or c.state == state)
+                and (topic is None or c in subscribers)]
+
+    def send(self, connections, packet_id, packet_data):
+        """ Queues the packet to connections.
+
+        Returns a list of (connection, delivered) where delivered is False
+        when the frame could not be queued.
+        """
+        body = common.encodeBody(packet_id, packet_data)
+        frames = {}  # Frame for each compression threshold
+        results = []
+        for c in connections:
+            try:
+                with c.send_lock:
+                    frame = frames.get(c.compression_threshold)
+                    if frame is None:
+                        frame = common.frameBody(body, c.compression_threshold)
+                        frames[c.compression_threshold] = frame
+                    c.countSent(packet_id, len(frame))
+                    c.write(frame)
+            except Exception:
+                logging.exception("Broadcast to %s failed.", c.address)
+                results.append((c, False))
+            else:
+                results.append((c, True))
+        return results
+
+    def broadcast(self, connections, packet_id, packet_data,
+                  state=None, topic=None):
+        """ Sends the packet to the connections matching state and topic. """
+        return self.send(self.select(connections, state, topic),
+                         packet_id, packet_data)
@@ -1,24 +1,28 @@
 # -*- coding: utf-8 -*-
 
-import select
 import socket as sk
 import logging
+import argparse
 
+import load
 import common
+import logqueue
+import reactor as rt
 import terminal
+import transfer
 
 import commands.client
 import commands.command
 
-MAX_LOOP_TIME = 0.1  # s
 server_ip = ("localhost", 23456)
+transfer_dir = None  # Directory of the files received, None: refused
 
 
 class Client(common.Client):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-        self.initState(commands.client.state_setups,
+        self.initState(commands.client.state_tables,
                        commands.command.state_handlers, [0, 0])
 
     def commandInput(self, term, text):
@@ -38,11 +42,23 @@ class Client(common.Client):
         except Exception:
             logging.exception("Exception in handleInput.")
 
+    def run(self):
+        super().run()
+        self.reactor.stop()  # No longer waits for the server.
+
     def connected(self):
         logging.info("Connected to %s.", self.address)
 
     def disconnected(self):
         logging.info("Disconnected from %s.", self.address)
+        transfer.cancelAll(self)
+        self.send_queue.clear()  # Closes the files of the chunks left
+
+    def acceptTransfer(self, name, size):
+        if transfer_dir is None:
+            return None
+        path = transfer.receivePath(transfer_dir, name)
+        return transfer.FileSink(path) if path is not None else None
 
 
 def main(term):
@@ -56,71 +72,121 @@ def main(term):
             ConnectionResetError):
         logging.error("Connection failed.")
     else:
-        client = Client(socket, server_ip)
+        socket.setblocking(0)
+        reactor = rt.Reactor()
+        client = Client(socket, server_ip, reactor)
+
+        def handle(s, mask):
+            """ When the socket is ready. """
+            if mask & rt.EVENT_WRITE:
+                client.sendQueued()
+            if mask & rt.EVENT_READ:
+                receive(s)
+
+        def receive(s):
+            """ When receiving something. """
+            try:
+                read = client.receive()
+            except BlockingIOError:
+                return
+            except (ConnectionAbortedError,
+                    ConnectionRefusedError,
+                    ConnectionResetError):
+                logging.warning("Connection failed.")
+                read = 0
+            except OSError as e:  # Ex: ETIMEDOUT
+                logging.warning("Connection failed: %s", e)
+                read = 0
+            if not read:  # The server disconnected.
+                reactor.unregister(s)
+                client.stop()
+
         try:
+            reactor.register(socket, rt.EVENT_READ, handle)
             client.start()
             term.callback = client.commandInput
 
-            outputs = []
-
-            # Loops when the socket is ready or every MAX_LOOP_TIME seconds.
-            while client.is_alive():
-                readable, writable, exceptional = select.select(
-                    [socket], outputs, [socket], MAX_LOOP_TIME)
-
-                # When receiving something.
-                for s in readable:
-                    try:
-                        data = s.recv(1024)
-                    except (ConnectionAbortedError,
-                            ConnectionRefusedError,
-                            ConnectionResetError):
-                        logging.warning("Connection failed.")
-                        data = None
-                    if data:  # If data is None / b'': the server disconnected.
-                        client.data_queue.put(data)  # TODO: public method
-                    else:
-                        client.stop()
-                        if s in outputs:
-                            outputs.remove(s)
-
-                # When ready to send something.
-                for s in writable:
-                    logging.debug("Writable.")
-
-                # When encountering an exception.
-                for s in exceptional:
-                    client.stop()
-                    if s in outputs:
-                        outputs.remove(s)
-                    logging.warning("Socket exception.")
+            # Waits for socket events until the client stops.
+            reactor.run()
         except Exception:
             client.stop()
             raise
+        finally:
+            reactor.close()
 
     socket.close()
 
 
+def mainLoad(scenario):
+    """ Runs the connections of a load.Scenario without terminal. """
+    generator = load.LoadGenerator(server_ip, scenario)
+    logging.warning("Opening %s connections to %s...",
+                    scenario.connections, server_ip)
+    for line in load.formatReport(generator.run()):
+        print(line)
+
+
 if __name__ == "__main__":
-    # Setting up "graphics".
+    parser = argparse.ArgumentParser(description="Runs the client.")
+    parser.add_argument("--host", default=server_ip[0],
+                        help="address of the server")
+    parser.add_argument("--port", type=int, default=server_ip[1])
+    parser.add_argument("--load", type=int, default=0, metavar="CONNECTIONS",
+                        help="opens CONNECTIONS clients running a scenario "
+                             "without terminal and reports their measures")
+    parser.add_argument("--connect-rate", type=float, default=0,
+                        help="connections opened per second, 0 for all at "
+                             "once")
+    parser.add_argument("--pings", type=int, default=1,
+                        help="status requests with ping of each connection")
+    parser.add_argument("--rate", type=float, default=1,
+                        help="pings per second of each connection, 0 for "
+                             "back to back")
+    parser.add_argument("--hold", type=float, default=0,
+                        help="seconds each connection stays idle after its "
+                             "pings")
+    parser.add_argument("--timeout", type=float, default=10,
+                        help="seconds to connect or receive a pong")
+    parser.add_argument("--compress", type=int, default=-1,
+                        metavar="THRESHOLD",
+                        help="requests compression of the packets")
+    parser.add_argument("--transfer-dir",
+                        help="directory where the files sent by the server "
+                             "are written, refused by default")
+    args = parser.parse_args()
+    server_ip = (args.host, args.port)
+    transfer_dir = args.transfer_dir
+
+    if args.load:
+        log_listener = logqueue.start(
+            [logging.StreamHandler()], logging.WARNING,
+            '[%(levelname)-5s] (%(threadName)-10s) %(message)s')
+        mainLoad(load.Scenario(args.load, args.connect_rate, args.pings,
+                               args.rate, args.hold, args.timeout,
+                               args.compress))
+        log_listener.stop()
+    else:
+        # Setting up "graphics".
 
-    def commandInput(term, text):
-        """ Handles terminal input before the client creation. """
-        text = text.strip().lower()
-        term.appendHistory(text)
-        logging.warning("Unhandled Command: %s", text)
+        def commandInput(term, text):
+            """ Handles terminal input before the client creation. """
+            text = text.strip().lower()
+            term.appendHistory(text)
+            logging.warning("Unhandled Command: %s", text)
 
-    term = terminal.Terminal(commandInput)
+        term = terminal.Terminal(commandInput)
 
-    logging.basicConfig(
-        level=logging.DEBUG,
-        format='[%(levelname)-5s] (%(threadName)-10s) %(message)s',
-        handlers=[terminal.TerminalHandler(term)])  # logging.StreamHandler()
+        # Records are handled by a thread, the network threads never wait.
+        log_listener = logqueue.start(
+            [terminal.TerminalHandler(term)],  # logging.StreamHandler()
+            logging.DEBUG,
+            '[%(levelname)-5s] (%(threadName)-10s) %(message)s')
 
-    # Main program.
-    try:
-        main(term)
-    except Exception:
-        logging.exception("Exception in \"main\".")
+        # Main program.
+        try:
+            main(term)
+        except Exception:
+            logging.exception("Exception in \"main\".")
 
-    term.stop()
+        log_listener.stop()
+        term.stop()
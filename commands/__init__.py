@@ -2,7 +2,8 @@
 
 """ Commands module
 
-*client* and *server* contains setups for client and server states.
+*client* and *server* contains the packets expected by clients and servers
+in each state.
 
 *command* contains handlers for commands in different states.
 
@@ -1,41 +1,72 @@
 # -*- coding: utf-8 -*-
 
-from .status import *
-
-
-def setupDefault(client):
-    """ Expected packets from server after connection. """
-
-    # 0:0x00 Request
-    client.waitForPacket(0, [], lambda *args: None)
+import common
+import transfer
 
-    # 0:0x01 Ping
-    client.waitForPacket(1, [
-        "Long"  # Payload
-    ], handlePing, "Received ping: %s.")
+from .status import *
 
 
 def setupStatus(client):
-    """ Expected packets from server after status request. """
+    """ Sends the status request and its ping. """
 
     # 1:0x00 Request
     client.pack(0, [])
 
     # 1:0x01 Ping
     logging.info("Sending ping: %s", client.ping_data)
-    client.ping_time = time.time()
+    client.ping_time = time.monotonic()
     client.pack(1, [("Long", client.ping_data)])  # Payload
 
-    # 1:0x00 Response
-    client.waitForPacket(0, [
-        ("String", 32767)  # JSON Response
-    ], handleResponse, repeat=False)
 
-    # 1:0x01 Pong
-    client.waitForPacket(1, [
-        "Long"  # Payload
-    ], handlePong, "Received pong in %.2f ms",
-        "Ping data has changed: %s", repeat=False)
+# Expected packets from server after connection.
+default = common.PacketTable()
+
+# 0:0x00 Request
+default.expect(0, [], ignore)
+
+# 0:0x01 Ping
+default.expect(1, [
+    "Long"  # Payload
+], handlePing, "Received ping from %s: %s.")
+
+# 0:0x02 Set Compression
+default.expect(2, [
+    "VarInt"  # Threshold
+], handleCompression)
+
+# 0:0x03 Transfer Start
+default.expect(transfer.TRANSFER_START, [
+    "VarInt",  # Transfer id
+    ("String", 32767),  # Name
+    "VarLong"  # Size
+], transfer.handleStart)
+
+# 0:0x04 Transfer Chunk
+default.expect(transfer.TRANSFER_CHUNK, [
+    "VarInt",  # Transfer id
+    "VarLong",  # Offset
+    ("Byte Array", "left")  # Data
+], transfer.handleChunk)
+
+# 0:0x05 Transfer Ack
+default.expect(transfer.TRANSFER_ACK, [
+    "VarInt",  # Transfer id
+    "VarLong"  # Offset
+], transfer.handleAck)
+
+# Expected packets from server after status request.
+status = common.PacketTable(setupStatus)
+
+# 1:0x00 Response
+status.expect(0, [
+    ("String", 32767)  # JSON Response
+], handleResponse, repeat=False)
+
+# 1:0x01 Pong
+status.expect(1, [
+    "Long"  # Payload
+], handlePong, "Received pong from %s in %.2f ms",
+    "%s changed the ping data: %s", repeat=False)
 
 
-state_setups = [setupDefault, setupStatus]
+state_tables = [default, status]
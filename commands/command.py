@@ -3,6 +3,10 @@
 import time
 import logging
 
+import transfer
+
+DEFAULT_THRESHOLD = 256  # Bytes from which packets are compressed
+
 
 def commandDefault(client, command):
     """ Handles default client commands (state 0). """
@@ -23,6 +27,38 @@ def commandDefault(client, command):
 
         client.setState(1)
 
+    elif command[0] == "compress":  # Compresses the following packets.
+        try:
+            assert len(command) == 2
+            threshold = int(command[1])
+        except (AssertionError, ValueError):
+            threshold = DEFAULT_THRESHOLD
+
+        # 0:0x02 Set Compression
+        client.setCompression(threshold)
+
+    elif command[0] in ("subscribe", "unsubscribe"):  # Topics of pings.
+        if len(command) != 2 or not command[1]:
+            logging.warning("Usage: %s TOPIC", command[0])
+            return
+        # 0:0x06 Subscribe
+        client.pack(6, [
+            ("String", command[1]),  # Topic (255)
+            ("Boolean", command[0] == "subscribe")  # Subscribed
+        ])
+
+    elif command[0] == "send":  # Sends a file to the server.
+        path = " ".join(command[1:])
+        if not path:
+            logging.warning("Usage: send PATH")
+            return
+        try:
+            outgoing = transfer.send(client, path)
+        except OSError as e:
+            logging.warning("Can't send %s: %s", path, e)
+        else:
+            logging.info("Sending %s (%s bytes).", path, outgoing.size)
+
 
 def commandStatus(client, command):
     """ Handles client commands in state 1. """
@@ -1,36 +1,68 @@
 # -*- coding: utf-8 -*-
 
+import common
+import transfer
+
 from .status import *
 
+# Expected packets from client after connection.
+default = common.PacketTable()
+
+# 0:0x00 Handshake
+default.expect(0, [
+    "VarInt",  # Protocol Version
+    ("String", 255),  # Server Address
+    "Unsigned Short",  # Server Port
+    "VarInt"  # Next State Enum
+], handleHandshake, repeat=False)
+
+# 0:0x01 Pong
+default.expect(1, [
+    "Long"  # Payload
+], handlePong, "%s sent back pong in %.2f ms",
+    "%s's ping data has changed: %s")
+
+# 0:0x02 Set Compression
+default.expect(2, [
+    "VarInt"  # Threshold
+], handleSetCompression)
 
-def setupDefault(client):
-    """ Expected packets from client after connection. """
+# 0:0x03 Transfer Start
+default.expect(transfer.TRANSFER_START, [
+    "VarInt",  # Transfer id
+    ("String", 32767),  # Name
+    "VarLong"  # Size
+], transfer.handleStart)
 
-    # 0:0x00 Handshake
-    client.waitForPacket(0, [
-        "VarInt",  # Protocol Version
-        ("String", 255),  # Server Address
-        "Unsigned Short",  # Server Port
-        "VarInt"  # Next State Enum
-    ], handleHandshake, repeat=False)
+# 0:0x04 Transfer Chunk
+default.expect(transfer.TRANSFER_CHUNK, [
+    "VarInt",  # Transfer id
+    "VarLong",  # Offset
+    ("Byte Array", "left")  # Data
+], transfer.handleChunk)
 
-    # 0:0x01 Pong
-    client.waitForPacket(1, [
-        "Long"  # Payload
-    ], handlePong, str(client.address) + " sent back pong in %.2f ms",
-        str(client.address) + "'s ping data has changed: %s")
+# 0:0x05 Transfer Ack
+default.expect(transfer.TRANSFER_ACK, [
+    "VarInt",  # Transfer id
+    "VarLong"  # Offset
+], transfer.handleAck)
 
+# 0:0x06 Subscribe
+default.expect(6, [
+    ("String", 255),  # Topic
+    "Boolean"  # Subscribed
+], handleSubscribe)
 
-def setupStatus(client):
-    """ Expected packets from client after status request. """
+# Expected packets from client after status request.
+status = common.PacketTable()
 
-    # 1:0x00 Request
-    client.waitForPacket(0, [], lambda *args: None, repeat=False)
+# 1:0x00 Request
+status.expect(0, [], ignore, repeat=False)
 
-    # 1:0x01 Ping
-    client.waitForPacket(1, [
-        "Long"  # Payload
-    ], handlePing, str(client.address) + " sent ping: %s.", repeat=False)
+# 1:0x01 Ping
+status.expect(1, [
+    "Long"  # Payload
+], handlePing, "%s sent ping: %s.", repeat=False)
 
 
-state_setups = [setupDefault, setupStatus]
+state_tables = [default, status]
@@ -4,6 +4,77 @@ import json
 import time
 import logging
 
+from threading import Lock
+
+import common
+
+MAX_SAMPLE = 20  # Clients listed in the status response
+
+
+class StatusCache:
+    """ Status response (1:0x00) framed once per version of propreties.
+
+    invalidate must be called when propreties change. Rebuilds can be
+    limited to one every min_interval seconds, serving the previous
+    response in between.
+    """
+
+    def __init__(self, propreties, min_interval=0):
+        self.propreties = propreties
+        self.min_interval = min_interval
+
+        self.version = 0  # Version of the propreties
+        self.frame_version = -1  # Version of the propreties in frames
+        self.frame_time = 0
+        self.body = None
+        self.frames = {}  # Framed body for each compression threshold
+        self.lock = Lock()
+
+    def invalidate(self):
+        """ Called when propreties change. """
+        self.version += 1
+
+    def currentVersion(self):
+        return self.version
+
+    def status(self):
+        """ Returns the propreties sent in the response. """
+        return self.propreties
+
+    def get(self, compression=-1):
+        """ Returns the bytes of the framed status response. """
+        version = self.currentVersion()
+        if self.frame_version != version:
+            self._build(version)
+        frame = self.frames.get(compression)
+        if frame is None:
+            with self.lock:
+                frame = common.frameBody(self.body, compression)
+                self.frames[compression] = frame
+        return frame
+
+    def _build(self, version):
+        with self.lock:
+            now = time.monotonic()
+            if self.frame_version != version and (
+                    self.body is None
+                    or now - self.frame_time >= self.min_interval):
+                status = self.status()
+                clients = status.get("clients", {})
+                if len(clients.get("sample", ())) > MAX_SAMPLE:
+                    # Keeps the response under the String limit.
+                    status = dict(status, clients=dict(
+                        clients, sample=clients["sample"][:MAX_SAMPLE]))
+                self.body = common.encodeBody(
+                    0, [("String", json.dumps(status))])
+                self.frames = {}
+                self.frame_version = version
+                self.frame_time = now
+
+
+def ignore(client, data):
+    """ Packet expected without anything to do. """
+
 
 def handleHandshake(client, data):
     """ Handshake request from client. """
@@ -18,11 +89,51 @@ def handleHandshake(client, data):
         client.setState(state)
 
         # 1:0x00 Response
-        client.pack(0, [("String", json.dumps(client.server_propreties))])
+        with client.send_lock:
+            frame = client.status_cache.get(client.compression_threshold)
+            client.countSent(0, len(frame))
+            client.write(frame)
     else:
         logging.warning("Unexpected next state: %s.", state)
 
 
+def handleSetCompression(client, data):
+    """ Compression requested by the client. """
+
+    # 0:0x02 Set Compression
+    # Following packets are compressed.
+    client.decoder.compressed = data[0] >= 0
+    threshold = client.server_compression if data[0] >= 0 else -1
+    logging.debug("%s compression threshold: %s, answering %s.",
+                  client.address, data[0], threshold)
+
+    client.setCompression(threshold)
+
+
+def handleCompression(client, data):
+    """ Compression threshold of the server. """
+
+    # 0:0x02 Set Compression
+    # Following packets are compressed.
+    client.decoder.compressed = data[0] >= 0
+    if client.decoder.compressed:
+        logging.info("Server compresses packets of %s bytes or more.",
+                     data[0])
+    else:
+        logging.info("Server doesn't compress packets.")
+
+
+def handleSubscribe(client, data):
+    """ Topic (un)subscribed by the client. """
+
+    # 0:0x06 Subscribe
+    topic, subscribed = data
+    if subscribed:
+        client.subscribe(topic)
+    else:
+        client.unsubscribe(topic)
+
+
 def handleResponse(client, data):
     """ Data received from server after status request. """
 
@@ -55,7 +166,7 @@ def handlePing(client, data, message):
     """ Data received after ping. """
 
     # 0x01 Ping
-    logging.info(message, data[0])
+    logging.info(message, client.address, data[0])
     # Pong
     client.pack(1, [("Long", data[0])])  # Payload
 
@@ -64,8 +175,14 @@ def handlePong(client, data, message, warning):
     """ Data received after pong. """
 
     # 0x01 Pong
-    logging.info(message, (time.time() - client.ping_time) * 1000)
+    if client.ping_time is None:
+        logging.warning("%s sent a pong without ping.", client.address)
+        return
+    rtt = time.monotonic() - client.ping_time
+    client.ping_time = None  # Answered
+    client.recordRtt(rtt)
+    logging.info(message, client.address, rtt * 1000)
 
     # Verify ping data unchanged
     if client.ping_data != data[0]:
-        logging.warning(warning, data[0])
+        logging.warning(warning, client.address, data[0])
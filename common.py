@@ -1,58 +1,246 @@
 # -*- coding: utf-8 -*-
 
+import os
+import zlib
 import logging
 import queue
 import time
-
-from threading import Thread
-from struct import pack, unpack
-
-
-def twosComp(value, bits):
-    """ Compute the 2's complement of int value. """
-    if (value & (1 << (bits - 1))) != 0:
-        value = value - (1 << bits)
-    return value
+import socket as sk
+
+from collections import deque
+from itertools import islice, takewhile
+from threading import Thread, Lock, RLock
+
+import schema
+import metrics
+import profiler
+import reactor as rt
+from schema import (twosComp, writeBoolean, writeInt, writeFloat,
+                    writeVarInt, writeString)
+from framing import (MAX_FRAME, MAX_READ_SIZE, FrameTooLarge, ReceiveBuffer,
+                     FrameDecoder)
+
+BUFFER_BUDGET = 1048576  # Bytes received or to send before pausing reads
+MIN_READ_SIZE = 1024  # Bytes asked by a read from a socket
+SHRINK_READS = 8  # Small reads in a row before reading less
+NO_TOPICS = frozenset()  # Broadcast topics of a connection, shared
+MAX_UNKNOWN_PACKETS = 32  # Unknown packets in a row before disconnecting
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")  # Buffers sent in a single call
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+SENDFILE = hasattr(os, "sendfile")  # FileRegions can be sent from disk
+
+# Number of packets and their bytes.
+PACKETS_RECEIVED = metrics.registry.summary(
+    "packets_received_bytes", "Packets received.", ("state", "id"))
+PACKETS_SENT = metrics.registry.summary(
+    "packets_sent_bytes", "Packets sent.", ("state", "id"))
+DECODE_ERRORS = metrics.registry.counter(
+    "decode_errors_total", "Connections stopped by an unexpected packet.")
+NO_DATA_ERRORS = metrics.registry.counter(
+    "no_data_errors_total", "Connections stopped waiting for data.")
+OVERSIZED_FRAMES = metrics.registry.counter(
+    "oversized_frames_total", "Connections stopped by a packet too large.")
+READ_PAUSES = metrics.registry.counter(
+    "read_pauses_total", "Reads paused for a connection over its budget.")
+
+
+class ReadSize:
+    """ Bytes asked by the reads of a connection, following its throughput.
+
+    Doubles when a read fills it, halves after SHRINK_READS reads in a row
+    using less than a quarter of it.
+    """
+    __slots__ = ("size", "small")
+
+    def __init__(self, size=MIN_READ_SIZE):
+        self.size = size
+        self.small = 0  # Small reads in a row
+
+    def update(self, read):
+        if read >= self.size:
+            self.size = min(self.size * 2, MAX_READ_SIZE)
+            self.small = 0
+        elif read < self.size // 4:
+            self.small += 1
+            if self.small >= SHRINK_READS:
+                self.size = max(self.size // 2, MIN_READ_SIZE)
+                self.small = 0
+        else:
+            self.small = 0
 
 
-def writeBoolean(bool):
-    return b'\x01' if bool else b'\x00'
+def encodeBody(packet_id, packet_data):
+    """ Returns the id and data of a packet from (type, value) pairs. """
+    types = tuple(t for t, _ in packet_data)
+    try:
+        packet_schema = schema.compile(types)
+    except RuntimeError:
+        raise RuntimeError("Unexpected type: " + str(types))
+    byte = writeVarInt(packet_id, 1) + packet_schema.encode(
+        [param for _, param in packet_data])
 
+    if logging.root.isEnabledFor(logging.DEBUG):
+        logging.debug("Sending packet  0x%02X (%03d) of size %s.",
+                      packet_id, packet_id, len(byte))
 
-def writeInt(value, size):
-    byte = bytearray()
-    for _ in range(size):
-        byte.append(value & 0xFF)
-        value >>= 8
-    byte.reverse()
     return byte
 
 
-def writeFloat(value, size):
-    assert size in [4, 8]
-    form = 'f' if size == 4 else 'd'
-    return pack('>' + form, value)
-
-
-def writeVarInt(value, size):
-    """ Returns the VarInt representation of value. """
-    byte = bytearray()
-    while True:
-        temp = value & 0x7F
-        value >>= 7
-        value &= int('1' * (32 * size - 7), 2)
-        if value != 0:
-            temp |= 0x80
-        byte.append(temp)
-        if value == 0:
-            break
-    return byte
+def frameBody(body, compression=-1):
+    """ Prefixes a packet body with its length.
 
+    If compression >= 0, the body is preceded by its uncompressed length
+    and zlib compressed when at least compression bytes long, or by 0.
+    """
+    if compression >= 0:
+        if len(body) >= compression:
+            body = writeVarInt(len(body), 1) + zlib.compress(body)
+        else:
+            body = b"\x00" + body
+    return writeVarInt(len(body), 1) + body
+
+
+def encodePacket(packet_id, packet_data, compression=-1):
+    """ Returns the frame of a packet from (type, value) pairs. """
+    return frameBody(encodeBody(packet_id, packet_data), compression)
+
+
+class FileRegion:
+    """ Bytes of a file queued to a SendQueue, sent with os.sendfile.
+
+    The file has to stay open while a region of it is queued: released(),
+    if given, is called once the region is sent or dropped.
+    """
+    __slots__ = ("file", "offset", "count", "released")
+
+    def __init__(self, file, offset, count, released=None):
+        self.file = file
+        self.offset = offset
+        self.count = count
+        self.released = released
+
+    def __len__(self):
+        return self.count
+
+    def read(self):
+        """ Returns the bytes of the region, ex: to compress them. """
+        if hasattr(os, "pread"):
+            return os.pread(self.file.fileno(), self.count, self.offset)
+        self.file.seek(self.offset)
+        return self.file.read(self.count)
+
+    def sendTo(self, socket):
+        sent = os.sendfile(socket.fileno(), self.file.fileno(),
+                           self.offset, self.count)
+        if sent == 0:
+            raise OSError("File shorter than expected.")
+        return sent
+
+    def skip(self, size):
+        self.offset += size
+        self.count -= size
+
+    def release(self):
+        """ Called once the region is no longer queued. """
+        released, self.released = self.released, None
+        if released is not None:
+            released()
+
+
+def isBuffer(frame):
+    return not isinstance(frame, FileRegion)
+
+
+class SendQueue:
+    """ Frames waiting for the socket to be writable.
+
+    Frames can be queued from any thread, they are sent together with a
+    single sendmsg call when possible, keeping the rest of a partial send.
+    FileRegions are sent on their own, with os.sendfile.
+    """
+    __slots__ = ("frames", "size", "regions", "lock")
+
+    def __init__(self):
+        self.frames = deque()
+        self.size = 0
+        self.regions = 0  # FileRegions queued
+        self.lock = Lock()
+
+    def __len__(self):
+        return self.size
+
+    def append(self, frame):
+        """ Queues a frame, returns True if the queue was empty. """
+        with self.lock:
+            self.frames.append(frame)
+            self.size += len(frame)
+            return len(self.frames) == 1
+
+    def extend(self, frames):
+        """ Queues frames in a row, returns True if the queue was empty. """
+        with self.lock:
+            empty = not self.frames
+            for frame in frames:
+                self.frames.append(frame)
+                self.size += len(frame)
+                if not isBuffer(frame):
+                    self.regions += 1
+            return empty
+
+    def flush(self, socket):
+        """ Sends queued frames, returns True once all of them are sent. """
+        sent_regions = []  # Released without the lock
+        try:
+            with self.lock:
+                return self._flush(socket, sent_regions)
+        finally:
+            for region in sent_regions:
+                region.release()
+
+    def _flush(self, socket, sent_regions):
+        while self.frames:
+            try:
+                if self.regions and not isBuffer(self.frames[0]):
+                    sent = self.frames[0].sendTo(socket)
+                elif hasattr(socket, "sendmsg"):
+                    frames = islice(self.frames, IOV_MAX)
+                    if self.regions:  # Buffers before the next region
+                        frames = takewhile(isBuffer, frames)
+                    sent = socket.sendmsg(frames)
+                else:
+                    sent = socket.send(self.frames[0])
+            except (BlockingIOError, InterruptedError):
+                return False
+            self.size -= sent
+
+            # Drops the frames sent, keeps the rest of a partial frame.
+            while sent > 0:
+                frame = self.frames[0]
+                if len(frame) <= sent:
+                    sent -= len(frame)
+                    self.frames.popleft()
+                    if self.regions and not isBuffer(frame):
+                        self.regions -= 1
+                        sent_regions.append(frame)
+                elif not isBuffer(frame):
+                    frame.skip(sent)
+                    return False
+                else:
+                    self.frames[0] = memoryview(frame)[sent:]
+                    return False
+        return True
 
-def writeString(value):
-    byte = writeVarInt(len(value), 1)
-    byte.extend(value.encode("utf-8"))
-    return byte
+    def clear(self):
+        """ Drops the queued frames, releasing their FileRegions. """
+        with self.lock:
+            regions = [f for f in self.frames if not isBuffer(f)]
+            self.frames.clear()
+            self.size = 0
+            self.regions = 0
+        for region in regions:
+            region.release()
 
 
 class NoDataError(Exception):
@@ -65,9 +253,55 @@ class NoDataError(Exception):
         return "No data received (" + str(self.where) + ")."
 
 
-class Client(Thread):
+def countError(error):
+    """ Counts an exception which stopped a connection. """
+    if isinstance(error, NoDataError):
+        NO_DATA_ERRORS.inc()
+    elif isinstance(error, FrameTooLarge):
+        OVERSIZED_FRAMES.inc()
+    else:
+        DECODE_ERRORS.inc()
+
+
+class PacketTable:
+    """ Packets expected in a state, shared by the connections in it.
+
+    setup(connection), if any, is called when a connection enters the
+    state, ex: to send packets.
+    """
+
+    def __init__(self, setup=None):
+        self.packets = {}  # Packet id: (Schema, funct, args, repeat)
+        self.setup = setup
+
+    def expect(self, packet_id, packet_data, packet_funct, *args,
+               repeat=True):
+        """ Runs packet_funct(connection, data, *args) on reception. """
+        assert packet_id not in self.packets
+        self.packets[packet_id] = (schema.compile(tuple(packet_data)),
+                                   packet_funct, args, repeat)
+
+    def copy(self):
+        table = PacketTable(self.setup)
+        table.packets = dict(self.packets)
+        return table
+
+
+class Connection:
+    """ Protocol state of a connection, independent of how it is driven.
+
+    Data passed to feed is decoded without blocking, so connections can be
+    run by an event loop instead of a thread each (see Client).
+    The packets expected in each state are PacketTables shared by every
+    connection, they are copied by a connection changing them.
+    """
+    __slots__ = ("socket", "address", "running", "state", "ping_data",
+                 "ping_time", "decoder", "send_queue", "send_lock",
+                 "compression_threshold", "topics", "packet_wait",
+                 "state_tables", "state_handlers", "state_fallbacks",
+                 "commandHandle", "transfers", "unknown_packets")
+
     def __init__(self, socket, address):
-        Thread.__init__(self)
         self.socket = socket
         self.address = address
 
@@ -75,135 +309,135 @@ class Client(Thread):
         self.state = None
 
         self.ping_data = int(time.time() * 1000)
-        self.ping_time = None
+        self.ping_time = None  # Monotonic time of the unanswered ping
 
-        self.current_data = bytearray()
-        self.data_queue = queue.Queue()
-        self.task_count = 0
+        self.decoder = FrameDecoder()  # Received packets
+        self.send_queue = SendQueue()
+        # Held from reading compression_threshold to queuing the frame, so
+        # every frame queued after a Set Compression packet uses its framing.
+        self.send_lock = RLock()
 
-        self.resetPackets()
+        # Set Compression packets switch the framing of each direction.
+        self.compression_threshold = -1  # Sent packets, -1 if uncompressed
+        self.topics = NO_TOPICS  # Replaced by the Broadcaster
+        self.transfers = None  # transfer.Transfers, once used
+        self.unknown_packets = 0  # Received in a row
 
-        # Set functions to pack and unpack all data types
-        self.data_type_handle = {
-            "Boolean": (writeBoolean,
-                        self.readBoolean),
-            "Byte": (lambda x: writeInt(x, 1),
-                     lambda: self.readInt(1, True)),
-            "Unsigned Byte": (lambda x: writeInt(x, 1),
-                              lambda: self.readInt(1, False)),
-            "Short": (lambda x: writeInt(x, 2),
-                      lambda: self.readInt(2, True)),
-            "Unsigned Short": (lambda x: writeInt(x, 2),
-                               lambda: self.readInt(2, False)),
-            "Int": (lambda x: writeInt(x, 4),
-                    lambda: self.readInt(4, True)),
-            "Long": (lambda x: writeInt(x, 8),
-                     lambda: self.readInt(8, True)),
-            "UUID": (lambda x: writeInt(x, 16),
-                     lambda: self.readInt(16, False)),
-            "Float": (lambda x: writeFloat(x, 4),
-                      lambda: self.readFloat(4)),
-            "Double": (lambda x: writeFloat(x, 4),
-                       lambda: self.readFloat(8)),
-            "VarInt": (lambda x: writeVarInt(x, 1),
-                       lambda: self.readVarInt(1)),
-            "VarLong": (lambda x: writeVarInt(x, 2),
-                        lambda: self.readVarInt(2)),
-            # Needs special unpack function
-            "String": (lambda x: writeString(x), None),
-            "Byte Array": (lambda x: x, None)
-        }
+        self.resetPackets()
 
         self.connected()
 
-    def run(self):
-        """ Executed when the thread starts. """
-        try:
-            self.running = True
-            data = self.data_queue.get()
-            self.task_count += 1
+    def feed(self, data):
+        """ Appends received data and decodes it. """
+        self.decoder.feed(data)
+        self.decode()
 
-            # Main loop.
-            while self.running:
-                if not data:
-                    raise NoDataError("Packet")
+    def decode(self):
+        """ Handles every complete packet received so far. """
+        while self.running:
+            packet = self.decoder.nextPacket()
+            if packet is None:
+                break
+            self.handlePacket(*packet)
 
-                self.current_data += bytearray(data)
-                self.recv()
+    def handleFrame(self, body):
+        """ Handles a packet body split by another FrameDecoder. """
+        self.handlePacket(*self.decoder.decodeBody(body))
 
-                while self.task_count > 0:
-                    self.data_queue.task_done()
-                    self.task_count -= 1
+    def write(self, data):
+        """ Queues bytes to be sent to the socket. """
+        if self.send_queue.append(data):
+            self.wantWrite()
 
-                data = self.data_queue.get()
-                self.task_count += 1
-        except Exception:
-            logging.exception("Exception in run.")
-            self.running = False
+    def writeParts(self, parts):
+        """ Queues buffers and FileRegions sent one after the other. """
+        if self.send_queue.extend(parts):
+            self.wantWrite()
 
-        while self.task_count > 0:
-            self.data_queue.task_done()
-            self.task_count -= 1
+    def wantWrite(self):
+        """ Called when data starts waiting to be sent. """
+        self.flush()
 
-        self.disconnected()
+    def flush(self):
+        """ Sends queued data, returns True if nothing is left.
+
+        A frame can be partly sent when sending fails, the connection is
+        then aborted rather than sending the next frames.
+        """
+        try:
+            return self.send_queue.flush(self.socket)
+        except OSError as e:
+            logging.warning("Sending to %s failed: %s", self.address, e)
+            self.send_queue.clear()
+            self.abort()
+            return True
+
+    def abort(self):
+        """ Shuts the socket down, the engine handles it as a disconnect. """
+        try:
+            self.socket.shutdown(sk.SHUT_RDWR)
+        except OSError:  # Already closed
+            pass
 
     def send(self, packet_id, data):
-        data = writeVarInt(packet_id, 1) + data
-        send = bytes(writeVarInt(len(data), 1) + data)
-        logging.debug("Sending %s.", send)
+        body = bytes(writeVarInt(packet_id, 1) + data)
+        with self.send_lock:
+            send = frameBody(body, self.compression_threshold)
+            if logging.root.isEnabledFor(logging.DEBUG):
+                logging.debug("Sending %s.", send)
 
-        self.socket.send(send)  # TODO: Handle potential errors.
+            self.countSent(packet_id, len(send))
+            self.write(send)
 
     def pack(self, packet_id, packet_data):
         """ Packs data to be sent """
-        byte = bytearray()
-        byte.extend(writeVarInt(packet_id, 1))
-        for t, param in packet_data:
-            try:
-                byte.extend(self.data_type_handle[t][0](param))
-            except KeyError:
-                raise RuntimeError("Unexpected type: " + str(t))
-
-        logging.debug("Sending packet  0x%02X (%03d) of size %s.",
-                      packet_id, packet_id, len(byte))
-
-        send = bytes(writeVarInt(len(byte), 1) + byte)
-
-        self.socket.send(send)
-
-    def recv(self):
-        # Read packet info and data.
-        left, _ = self.readVarInt(1)  # Length
-        if left <= 0:
-            logging.warning("Received packet of length %s.", left)
-            while len(self.current_data) > 0 and self.current_data[0] == 0:
-                # Removing b"\x00" bytes (assuming erroneous data).
-                self.current_data.pop(0)
-            return
-        packet_id, length = self.readVarInt(1)
-
-        logging.debug("Received packet %s of size %s.", packet_id, left)
-        left -= length
-        assert left >= 0
-
-        self.waitForData(left, "Byte")
+        body = encodeBody(packet_id, packet_data)
+        with self.send_lock:
+            frame = frameBody(body, self.compression_threshold)
+            self.countSent(packet_id, len(frame))
+            self.write(frame)
+
+    def setCompression(self, threshold):
+        """ Sends 0:0x02 Set Compression, framing the next packets with it.
+        """
+        with self.send_lock:
+            self.pack(2, [("VarInt", threshold)])  # Threshold
+            self.compression_threshold = threshold
+
+    def countSent(self, packet_id, size):
+        """ Counts a packet written to the connection. """
+        PACKETS_SENT.inc((self.state, packet_id), size)
+
+    def handlePacket(self, packet_id, data, size):
+        """ Runs the function waiting for a packet, with its data. """
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug("Received packet %s of size %s.",
+                          packet_id, len(data))
 
         # Check if the packet was expected
-        if packet_id in self.packet_wait:
+        expected = self.packet_wait.get(packet_id)
+        if expected is not None or self.knownPacket(packet_id):
+            PACKETS_RECEIVED.inc((self.state, packet_id), size)
+            self.unknown_packets = 0
+        else:
+            # Ids chosen by the peer, counted under a single label.
+            PACKETS_RECEIVED.inc((self.state, "unknown"), size)
+            self.unknown_packets += 1
+            if self.unknown_packets > MAX_UNKNOWN_PACKETS:
+                raise RuntimeError("%s unknown packets in a row."
+                                   % self.unknown_packets)
+        if expected is not None:
             # Call function with unpacked data
-            packet_data, packet_funct, repeat = self.packet_wait[packet_id]
+            packet_schema, packet_funct, args, repeat = expected
             if not repeat:  # No longer expecting packet
-                del self.packet_wait[packet_id]
-            packet_funct(self, self.unpack(left, packet_data))
-        else:
-            self.waitForData(left, "Byte")
-            byte = self.current_data[:left]
-            self.current_data = self.current_data[left:]
-
-            if len(byte) > 30:
-                logging.debug("Data: %s...", byte.hex()[:30])
+                self.packet_wait = {i: p for i, p in self.packet_wait.items()
+                                    if i != packet_id}
+            packet_funct(self, self.unpack(data, packet_schema), *args)
+        elif logging.root.isEnabledFor(logging.DEBUG):
+            if len(data) > 15:
+                logging.debug("Data: %s...", data[:15].hex())
             else:
-                logging.debug("Data: %s.", byte.hex())
+                logging.debug("Data: %s.", data.hex())
         if len(self.packet_wait) <= 0:
             # If no more expected data
             if self.state:
@@ -212,140 +446,245 @@ class Client(Thread):
             else:
                 # Stop client
                 self.running = False
-                self.data_queue.put(None)
-
-    def unpack(self, left, expected_data):
-        """ Unpacks data to be used """
-        result = []
-
-        for n, t in enumerate(expected_data):
-            if isinstance(t, tuple):
-                if t[0] == "String":
-                    data, length = self.readString(t[1])
-                elif t[0] == "Byte Array":
-                    param = t[1]  # Determines the size of the Byte Array
-
-                    # Fixed size (ex: param=256).
-                    if not isinstance(param, str):
-                        length = param
-                    # Size determined by the last data (ex: param="lastVarInt")
-                    elif len(param) > 4 and param.startswith("last"):
-                        if n > 0 and expected_data[n - 1] == param[4:]:
-                            length = result[n - 1]
-                        else:
-                            raise RuntimeError("Last type doesn't match")
-                    # Until the end of the packet (param="left").
-                    elif param == "left":
-                        length = left
-                    else:
-                        raise RuntimeError("Unexpected parameter: "
-                                           + str(param))
-
-                    self.waitForData(length,
-                                     "Byte Array of length %s" % length)
-                    data = self.current_data[:length]
-                    self.current_data = self.current_data[length:]
-                else:
-                    raise RuntimeError("Unexpected type received: " + str(t))
-            else:
-                data, length = self.data_type_handle[t][1]()
-
-            left -= length
-            if left < 0:
-                raise RuntimeError("Received more than expected (%s)." % -left)
-            result.append(data)
+                self.interrupt()
 
-        assert left == 0  # Assert all data is used
+    def knownPacket(self, packet_id):
+        """ Returns True if the packet is expected in the current state. """
+        return self.state is not None \
+            and packet_id in self.state_tables[self.state].packets
 
-        return result
+    def unpack(self, data, packet_schema):
+        """ Unpacks data to be used """
+        return packet_schema.decode(ReceiveBuffer(data), len(data))
 
-    def initState(self, setups, handlers, fallbacks, default=0):
+    def initState(self, tables, handlers, fallbacks, default=0):
         if handlers:
-            assert len(setups) == len(handlers)
-        assert len(setups) == len(fallbacks)
-        self.state_setups = setups
+            assert len(tables) == len(handlers)
+        assert len(tables) == len(fallbacks)
+        self.state_tables = tables
         self.state_handlers = handlers
         self.state_fallbacks = fallbacks
         self.setState(default)
 
     def setState(self, state):
         self.state = state
-        self.resetPackets()
+        table = self.state_tables[state]
+        self.packet_wait = table.packets  # Shared, never modified
         if self.state_handlers:
             self.commandHandle = self.state_handlers[state]
-        self.state_setups[state](self)
+        if table.setup is not None:
+            table.setup(self)
 
     def waitForPacket(self, packet_id, packet_data, packet_funct,
                       *args, repeat=True):
-        """ Runs the function associated to the reception of a packet. """
+        """ Runs the function associated to the reception of a packet.
+
+        Only for this connection, until its state changes.
+        """
         assert packet_id not in self.packet_wait
-        self.packet_wait[packet_id] = (
-            packet_data, lambda c, d: packet_funct(c, d, *args), repeat)
+        self.packet_wait = dict(self.packet_wait)
+        self.packet_wait[packet_id] = (schema.compile(tuple(packet_data)),
+                                       packet_funct, args, repeat)
 
     def resetPackets(self):
         self.packet_wait = {}
 
-    def waitForData(self, size, where):
-        """ Wait for enough data to be received. """
-        while len(self.current_data) < size:
-            data = self.data_queue.get()
-            self.task_count += 1
-            if not data:
-                raise NoDataError(where)
-            self.current_data += bytearray(data)
-
-    def readBoolean(self):
-        self.waitForData(1, "Boolean")
-        data = True if self.current_data.pop(0) == b'\x01' else False
-        return data, 1
-
-    def readInt(self, size, signed):
-        """ Returns a Int value and its size from the current_data. """
-        self.waitForData(size, "Int")
-        byte = self.current_data[:size]
-        self.current_data = self.current_data[size:]
-        return int.from_bytes(byte, "big", signed=signed), size
-
-    def readFloat(self, size):
-        """ Returns a Float value and its size from the current_data. """
-        assert size in [4, 8]
-        form = 'f' if size == 4 else 'd'
-        self.waitForData(size, "Float")
-        byte = self.current_data[:size]
-        self.current_data = self.current_data[size:]
-        return unpack('>' + form, byte)[0], size
-
-    def readVarInt(self, size):
-        """ Returns a VarInt value and its size from the current_data. """
-        value, i = 0, 0
-        while True:
-            self.waitForData(1, "VarInt")
-            byte = self.current_data.pop(0)
-            value |= (byte & 0x7F) << 7 * i
-            i += 1
-            if not byte & 0x80:
-                break
-        if i > 5 * size:
-            raise RuntimeError("VarInt longer than expected.")
-        return twosComp(value, 32 * size), i
-
-    def readString(self, max_length):
-        """ Returns a String value and its size from the current_data. """
-        length, vlength = self.readVarInt(1)
-        if length > max_length:
-            raise RuntimeError("String longer than expected")
-        self.waitForData(length, "String")
-        string = self.current_data[:length].decode("utf-8")
-        self.current_data = self.current_data[length:]
-        return string, length + vlength
+    def interrupt(self):
+        """ Called when the connection stops expecting data. """
+
+    def recordRtt(self, rtt):
+        """ Called with the round trip time of a ping in seconds. """
+
+    def acceptTransfer(self, name, size):
+        """ Returns the sink of a transfer received, None to refuse it.
+
+        See transfer.py, ex: transfer.FileSink(path).
+        """
+        return None
 
     def stop(self):
         self.running = False
-        self.data_queue.put(None)
-        self.join()
+        self.interrupt()
+
+    def close(self):
+        self.socket.close()
+        self.send_queue.clear()
+
+    def queueDepth(self):
+        """ Returns the number of received chunks waiting to be decoded. """
+        return 0
 
     def connected(self):
         logging.debug("Connected: %s", self.address)
 
     def disconnected(self):
         logging.debug("Disconnected: %s", self.address)
+
+
+class ReactorConnection(Connection):
+    """ Connection with a socket registered to a reactor.Reactor.
+
+    The owner of the reactor calls received with the data read from the
+    socket, eof when it is closed and sendQueued when it is writable.
+
+    Reads are paused while the data received and not decoded yet plus the
+    data not sent yet are over buffer_budget, until half of it is left.
+    """
+
+    __slots__ = ("reactor", "writing", "reading", "buffer_budget",
+                 "read_size")
+
+    def __init__(self, socket, address, reactor):
+        self.reactor = reactor
+        self.writing = False  # Waiting for the socket to be writable
+        self.reading = True  # Not paused
+        self.buffer_budget = BUFFER_BUDGET
+        self.read_size = ReadSize()
+
+        super().__init__(socket, address)
+
+    def receive(self):
+        """ Reads from the socket in the reactor thread.
+
+        Returns the number of bytes read, 0 when the socket is closed.
+        """
+        read = self.decoder.receiveFrom(self.socket, self.read_size.size)
+        self.read_size.update(read)
+        if read:
+            self.decode()
+        return read
+
+    def received(self, data):
+        """ Called by the reactor thread with received data. """
+        self.feed(data)
+
+    def eof(self):
+        """ Called by the reactor thread when the socket is closed. """
+        self.stop()
+
+    def wantWrite(self):
+        # Frames queued until then are sent together by the reactor.
+        self.reactor.callSoon(self.sendQueued)
+
+    def sendQueued(self):
+        """ Sends queued data from the reactor thread. """
+        if self.socket.fileno() < 0:  # Already closed
+            return
+        writing = not self.flush()
+        if writing != self.writing:
+            self.writing = writing
+            self.updateEvents()
+        if not self.reading:
+            self.checkBudget()
+
+    def updateEvents(self):
+        events = (rt.EVENT_READ if self.reading else 0) \
+            | (rt.EVENT_WRITE if self.writing else 0)
+        self.reactor.modify(self.socket, events)
+
+    def pendingInput(self):
+        """ Returns the bytes received and waiting to be decoded. """
+        return 0
+
+    def buffered(self):
+        return self.pendingInput() + len(self.send_queue)
+
+    def checkBudget(self):
+        """ Pauses or resumes reads against the budget, in the reactor. """
+        if self.socket.fileno() < 0:  # Already closed
+            return
+        if self.reading and self.buffered() > self.buffer_budget:
+            self.reading = False
+            self.updateEvents()
+            READ_PAUSES.inc()
+            # Data decoded meanwhile may not have scheduled a check.
+        if not self.reading and self.buffered() <= self.buffer_budget // 2:
+            self.reading = True
+            self.updateEvents()
+
+    def consumed(self):
+        """ Called by the decoding thread after decoding received data. """
+        if not self.reading:
+            self.reactor.callSoon(self.checkBudget)
+
+    def close(self):
+        # The socket is unregistered by the reactor thread.
+        self.reactor.callSoon(self._close)
+
+    def _close(self):
+        self.reactor.unregister(self.socket)
+        self.socket.close()
+        self.send_queue.clear()
+
+
+class Client(ReactorConnection, Thread):
+    """ Connection decoding received data in its own thread. """
+
+    def __init__(self, socket, address, reactor):
+        Thread.__init__(self)
+        self.data_queue = queue.Queue()
+        self.task_count = 0
+        self.queued_bytes = 0  # Written by the reactor thread only
+        self.dequeued_bytes = 0  # Written by the client thread only
+
+        ReactorConnection.__init__(self, socket, address, reactor)
+
+    def run(self):
+        """ Executed when the thread starts. """
+        try:
+            self.running = True
+            data = self.data_queue.get()
+            self.task_count += 1
+
+            # Main loop.
+            while self.running:
+                if not data:
+                    raise NoDataError("Packet")
+
+                profiler.sync()
+                self.dequeued_bytes += len(data)
+                self.consumed()
+                self.feed(data)
+
+                while self.task_count > 0:
+                    self.data_queue.task_done()
+                    self.task_count -= 1
+
+                data = self.data_queue.get()
+                self.task_count += 1
+        except Exception as e:
+            countError(e)
+            logging.exception("Exception in run.")
+            self.running = False
+
+        while self.task_count > 0:
+            self.data_queue.task_done()
+            self.task_count -= 1
+
+        self.disconnected()
+
+    def receive(self):
+        # The data is decoded by the client thread, not in the reactor.
+        data = self.socket.recv(self.read_size.size)
+        self.read_size.update(len(data))
+        if data:
+            self.received(data)
+        return len(data)
+
+    def received(self, data):
+        self.queued_bytes += len(data)
+        self.data_queue.put(data)
+
+    def pendingInput(self):
+        return self.queued_bytes - self.dequeued_bytes
+
+    def queueDepth(self):
+        return self.data_queue.qsize()
+
+    def interrupt(self):
+        self.data_queue.put(None)
+
+    def stop(self):
+        super().stop()
+        if self.is_alive():
+            self.join()
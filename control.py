@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+""" Commands of the server received on a UNIX socket, replied in JSON.
+
+A connection sends commands as lines of text, the same as in the terminal
+(ex: "list 1"), and receives a JSON object per command on its own line:
+{"command": "list", "ok": true, "result": {...}}
+or {"command": "list", "ok": false, "error": "..."}.
+"""
+
+import os
+import sys
+import json
+import socket as sk
+import logging
+
+from threading import Condition, Thread
+
+IDLE_TIMEOUT = 60  # s without command before closing a connection
+STOP_TIMEOUT = 1  # s waiting for the replies of running commands
+MAX_LINE = 4096  # Bytes of a command
+
+
+class ControlServer(Thread):
+    """ Runs the commands of every connection to a UNIX socket.
+
+    funct(text) runs a command and returns its result as a dict, None when
+    the command is unknown.
+    """
+
+    def __init__(self, path, funct):
+        super().__init__(name="Control", daemon=True)
+        self.path = path
+        self.funct = funct
+        self.running = 0  # Commands running or replying
+        self.idle = Condition()
+
+        if os.path.exists(path):
+            os.remove(path)
+        self.socket = sk.socket(sk.AF_UNIX, sk.SOCK_STREAM)
+        self.socket.bind(path)
+        os.chmod(path, 0o600)  # Only the user running the server
+        self.socket.listen()
+
+    def run(self):
+        while True:
+            try:
+                connection, _ = self.socket.accept()
+            except OSError:  # Closed
+                break
+            Thread(target=self.serve, args=(connection,),
+                   name="Control", daemon=True).start()
+
+    def serve(self, connection):
+        """ Replies to the commands of a connection until it closes. """
+        with connection:
+            connection.settimeout(IDLE_TIMEOUT)
+            try:
+                file = connection.makefile("rb")
+                while True:
+                    line = file.readline(MAX_LINE + 1)
+                    if not line:
+                        break
+                    if len(line) > MAX_LINE:
+                        self.reply(connection, {"command": None, "ok": False,
+                                                "error": "Command too long."})
+                        break
+                    text = line.decode("utf-8", "replace").strip()
+                    if not text:
+                        continue
+                    with self.idle:
+                        self.running += 1
+                    try:
+                        self.reply(connection, self.execute(text))
+                    finally:
+                        with self.idle:
+                            self.running -= 1
+                            self.idle.notify_all()
+            except OSError:  # Timeout or closed by the other side
+                pass
+
+    def reply(self, connection, reply):
+        connection.sendall(json.dumps(reply).encode("utf-8") + b"\n")
+
+    def execute(self, text):
+        """ Runs a command, returns its reply. """
+        name = text.split(" ")[0].lower()
+        try:
+            result = self.funct(text)
+        except Exception as e:
+            logging.exception("Exception in command.")
+            return {"command": name, "ok": False, "error": str(e)}
+        if result is None:
+            return {"command": name, "ok": False, "error": "Unknown command."}
+        if "error" in result:
+            return {"command": name, "ok": False, "error": result["error"]}
+        return {"command": name, "ok": True, "result": result}
+
+    def stop(self):
+        """ Closes the socket, ex: the reply to stop is sent first. """
+        with self.idle:
+            self.idle.wait_for(lambda: self.running == 0, STOP_TIMEOUT)
+        try:
+            self.socket.shutdown(sk.SHUT_RDWR)  # Wakes up accept
+        except OSError:
+            pass
+        self.socket.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def send(path, text, timeout=IDLE_TIMEOUT):
+    """ Sends a command to a ControlServer, returns its reply. """
+    with sk.socket(sk.AF_UNIX, sk.SOCK_STREAM) as socket:
+        socket.settimeout(timeout)
+        socket.connect(path)
+        socket.sendall(text.encode("utf-8") + b"\n")
+        socket.shutdown(sk.SHUT_WR)
+        with socket.makefile("rb") as file:
+            line = file.readline()
+    if not line:
+        raise ConnectionError("No reply from %s." % path)
+    return json.loads(line)
+
+
+if __name__ == "__main__":
+    # python control.py <socket path> <command>...
+    if len(sys.argv) < 3:
+        print("Usage: python control.py SOCKET COMMAND [ARGUMENT...]")
+        sys.exit(2)
+    reply = send(sys.argv[1], " ".join(sys.argv[2:]))
+    print(json.dumps(reply))
+    sys.exit(0 if reply["ok"] else 1)
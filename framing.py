@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+
+""" Decoding of length-prefixed packets from received bytes, without I/O.
+
+A FrameDecoder is pushed the bytes received in any fragments and returns the
+complete packets, so a single thread can decode many connections from an
+event loop, and the decoding can be benchmarked or fuzzed on its own.
+"""
+
+import zlib
+import logging
+
+from schema import twosComp, readVarInt
+
+COMPACT_SIZE = 4096  # Read bytes kept before compacting a ReceiveBuffer
+MAX_FRAME = 2097151  # Bytes of a packet, as announced by its length
+MAX_READ_SIZE = 262144  # Bytes asked by a read from a socket
+ZEROS = memoryview(bytes(MAX_READ_SIZE))  # Space reserved for a read
+
+
+class FrameTooLarge(Exception):
+    """ When a packet is announced larger than allowed. """
+
+    def __init__(self, size, max_size):
+        self.size = size
+        self.max_size = max_size
+
+    def __str__(self):
+        return "Packet of %s bytes (max %s)." % (self.size, self.max_size)
+
+
+class ReceiveBuffer:
+    """ Received bytes read through a cursor instead of being shifted.
+
+    Reads return memoryview slices of the underlying bytearray, the bytes
+    already read are only dropped once they make up most of the buffer.
+    A buffer created with data reads it in place and can't be extended.
+    """
+    __slots__ = ("data", "pos", "compact_size")
+
+    def __init__(self, data=None, compact_size=COMPACT_SIZE):
+        self.data = bytearray() if data is None else data
+        self.pos = 0
+        self.compact_size = compact_size
+
+    def __len__(self):
+        return len(self.data) - self.pos
+
+    def extend(self, data):
+        """ Appends received data at the end of the buffer. """
+        if self.pos >= self.compact_size and self.pos * 2 >= len(self.data):
+            self.compact()
+        try:
+            self.data += data
+        except BufferError:
+            # A slice returned by read is still in use, the data is copied
+            # to a new bytearray instead of being resized in place.
+            self.data = self.data[self.pos:] + data
+            self.pos = 0
+
+    def receiveFrom(self, socket, size):
+        """ Reads up to size bytes from a socket at the end of the buffer.
+
+        The socket writes into the buffer itself (recv_into), without
+        intermediate bytes. Returns the number of bytes read, 0 when the
+        socket is closed.
+        """
+        self.extend(ZEROS[:size])
+        end = len(self.data) - size
+        read = 0
+        view = memoryview(self.data)[end:]
+        try:
+            read = socket.recv_into(view)
+        finally:
+            view.release()
+            del self.data[end + read:]
+        return read
+
+    def compact(self):
+        """ Drops the bytes already read. """
+        try:
+            del self.data[:self.pos]
+        except BufferError:
+            self.data = self.data[self.pos:]
+        self.pos = 0
+
+    def read(self, size):
+        """ Returns a zero-copy view of the next size bytes. """
+        assert size <= len(self)
+        view = memoryview(self.data)[self.pos:self.pos + size]
+        self.pos += size
+        return view
+
+    def unpackFrom(self, struct):
+        """ Unpacks the next bytes with a struct.Struct. """
+        assert struct.size <= len(self)
+        values = struct.unpack_from(self.data, self.pos)
+        self.pos += struct.size
+        return values
+
+    def skip(self, size):
+        assert size <= len(self)
+        self.pos += size
+
+    def skipNull(self):
+        """ Skips null bytes, returns the number of bytes skipped. """
+        start = self.pos
+        while self.pos < len(self.data) and self.data[self.pos] == 0:
+            self.pos += 1
+        return self.pos - start
+
+
+class FrameDecoder:
+    """ Splits the bytes received from a connection into packets.
+
+    Bytes are pushed with feed (or receiveFrom) as they arrive, nextPacket
+    returns the complete packets one at a time and None once the next one
+    is incomplete, needed being then the number of bytes it still misses.
+    Packets are decoded one at a time because handling one can change how
+    the next ones are framed (compressed).
+    """
+    __slots__ = ("buffer", "max_frame", "compressed", "needed")
+
+    def __init__(self, max_frame=MAX_FRAME):
+        self.buffer = ReceiveBuffer()
+        self.max_frame = max_frame  # Bytes of a packet, compressed or not
+        self.compressed = False  # Bodies start with their uncompressed size
+        self.needed = 1  # Bytes missing from the next packet
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def feed(self, data):
+        """ Appends received bytes. """
+        self.buffer.extend(data)
+        self.needed -= len(data)
+
+    def receiveFrom(self, socket, size):
+        """ Reads from a socket, at least the bytes needed if they fit. """
+        read = self.buffer.receiveFrom(
+            socket, min(max(size, self.needed), MAX_READ_SIZE))
+        self.needed -= read
+        return read
+
+    def nextFrame(self):
+        """ Returns the body of the next packet, None while incomplete.
+
+        The body is a view of the received bytes, without its length.
+        Raises FrameTooLarge as soon as the length is over max_frame.
+        """
+        if self.needed > 0:  # Not even parsing the length again
+            return None
+        buffer = self.buffer
+        while True:
+            header = self.readLength()
+            if header is None:
+                self.needed = 1
+                return None
+            length, size = header
+            if length > self.max_frame:
+                raise FrameTooLarge(length, self.max_frame)
+            if length > 0:
+                break
+            logging.warning("Received packet of length %s.", length)
+            # Removing b"\x00" bytes (assuming erroneous data).
+            buffer.skip(size)
+            buffer.skipNull()
+
+        if size + length > len(buffer):
+            self.needed = size + length - len(buffer)
+            return None
+        buffer.skip(size)
+        body = buffer.read(length)
+        self.needed = 1 - len(buffer)
+        return body
+
+    def readLength(self):
+        """ Returns the length of the next packet and the size of its VarInt.
+
+        Nothing is read, returns None while the VarInt is incomplete.
+        """
+        data, pos = self.buffer.data, self.buffer.pos
+        value = 0
+        for i in range(5):
+            if pos + i >= len(data):
+                return None
+            byte = data[pos + i]
+            value |= (byte & 0x7F) << 7 * i
+            if not byte & 0x80:
+                return twosComp(value, 32), i + 1
+        raise RuntimeError("VarInt longer than expected.")
+
+    def decodeBody(self, body):
+        """ Returns the id, the data and the size of a packet body. """
+        size = len(body)  # Received, before decompression
+        if self.compressed:
+            body = self.decompress(body)
+        if body and body[0] < 0x80:  # Id of a single byte
+            return body[0], memoryview(body)[1:], size
+        buffer = ReceiveBuffer(body)
+        packet_id, _ = readVarInt(buffer, 32)
+        return packet_id, buffer.read(len(buffer)), size
+
+    def decompress(self, body):
+        """ Returns the uncompressed id and data of a packet body. """
+        buffer = ReceiveBuffer(body)
+        data_length, _ = readVarInt(buffer, 32)
+        if data_length <= 0:  # Sent uncompressed
+            return buffer.read(len(buffer))
+        if data_length > self.max_frame:
+            raise FrameTooLarge(data_length, self.max_frame)
+
+        decompressor = zlib.decompressobj()
+        data = decompressor.decompress(buffer.read(len(buffer)), data_length)
+        if len(data) != data_length or decompressor.unconsumed_tail:
+            raise RuntimeError("Compressed packet of unexpected size.")
+        return data
+
+    def nextPacket(self):
+        """ Returns the next (packet id, data, size), None if incomplete. """
+        body = self.nextFrame()
+        if body is None:
+            return None
+        return self.decodeBody(body)
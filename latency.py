@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+""" Round trip times of the connections: histograms and moving averages.
+
+Histogram counts microseconds in HDR style buckets: exact below
+2 * SUB_BUCKETS, then SUB_BUCKETS buckets per power of two, so a percentile
+is within 1 / SUB_BUCKETS of the value measured whatever its magnitude and
+a histogram only holds the buckets used.
+"""
+
+SUB_BITS = 4
+SUB_BUCKETS = 1 << SUB_BITS  # Buckets per power of two (6.25 % precision)
+SMOOTHING = 0.125  # Weight of a new RTT in the average (as TCP's SRTT)
+
+
+def bucketIndex(value):
+    """ Returns the bucket of an integer value >= 0. """
+    if value < 2 * SUB_BUCKETS:
+        return value
+    shift = value.bit_length() - SUB_BITS - 1
+    return shift * SUB_BUCKETS + (value >> shift)
+
+
+def bucketValue(index):
+    """ Returns the highest value of a bucket. """
+    if index < 2 * SUB_BUCKETS:
+        return index
+    shift = index // SUB_BUCKETS - 1
+    return ((index % SUB_BUCKETS + SUB_BUCKETS + 1) << shift) - 1
+
+
+class Histogram:
+    """ Counts of integer values >= 0 by bucket.
+
+    Recorded by a single thread, other threads can merge it at any time.
+    """
+    __slots__ = ("counts", "count", "max")
+
+    def __init__(self):
+        self.counts = {}  # Bucket: values
+        self.count = 0
+        self.max = 0
+
+    def record(self, value):
+        index = bucketIndex(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """ Adds the values of another histogram. """
+        counts = other.counts.copy()  # Atomic, other may be recording
+        for index, count in counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += sum(counts.values())
+        self.max = max(self.max, other.max)
+
+    def percentile(self, q):
+        """ Returns the q percentile (0 to 100), None without values. """
+        if not self.count:
+            return None
+        rank = max(1, q / 100 * self.count)
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(bucketValue(index), self.max)
+        return self.max
+
+
+class RttStats:
+    """ Round trip times of a connection, in seconds. """
+    __slots__ = ("histogram", "average", "last")
+
+    def __init__(self):
+        self.histogram = Histogram()  # Microseconds
+        self.average = None  # Exponentially weighted moving average
+        self.last = None
+
+    def __len__(self):
+        return self.histogram.count
+
+    def record(self, rtt):
+        self.last = rtt
+        if self.average is None:
+            self.average = rtt
+        else:
+            self.average += SMOOTHING * (rtt - self.average)
+        # Counted last, a counted connection always has an average.
+        self.histogram.record(max(0, int(rtt * 1000000)))
+
+    def percentile(self, q):
+        value = self.histogram.percentile(q)
+        return None if value is None else value / 1000000
+
+
+def fleetHistogram(stats):
+    """ Returns the Histogram merging the RttStats of many connections. """
+    histogram = Histogram()
+    for s in stats:
+        histogram.merge(s.histogram)
+    return histogram
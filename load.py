@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+
+""" Load generator running many client connections in one thread.
+
+Every connection replays the same scenario: connection, optional
+compression request, status requests with a ping (handshake, request, ping,
+response and pong) at a given rate, then stays idle before disconnecting.
+"""
+
+import time
+import heapq
+import errno
+import logging
+import socket as sk
+
+from collections import Counter
+
+import common
+import reactor as rt
+
+import commands.client
+import commands.command
+
+from benchmarks import percentile
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+
+def raiseFileLimit(count):
+    """ Raises the limit of open files up to count if possible. """
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = count if hard == resource.RLIM_INFINITY else min(count, hard)
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+        except (ValueError, OSError):
+            logging.warning("Could not raise the open files limit to %s.",
+                            wanted)
+
+
+class Scenario:
+    """ What every connection of the load does. """
+
+    def __init__(self, connections=100, connect_rate=0, pings=1, rate=1,
+                 hold=0, timeout=10, compression=-1):
+        self.connections = connections
+        self.connect_rate = connect_rate  # Connections/s, 0: all at once
+        self.pings = pings  # Status requests with ping per connection
+        self.rate = rate  # Pings/s of each connection, 0: back to back
+        self.hold = hold  # s idle after the pings before disconnecting
+        self.timeout = timeout  # s to connect or to receive a pong
+        self.compression = compression  # Threshold requested, -1: none
+
+
+def handleCompression(client, data):
+    """ Compression threshold of the server, pings can start. """
+    commands.client.handleCompression(client, data)
+    if client.negotiating:
+        client.negotiating = False
+        client.load.at(time.monotonic(), client.ping)
+
+
+# Expected packets from server after connection.
+default = commands.client.default.copy()
+
+# 0:0x02 Set Compression
+del default.packets[2]
+default.expect(2, [
+    "VarInt"  # Threshold
+], handleCompression)
+
+state_tables = [default, commands.client.status]
+
+
+class LoadClient(common.ReactorConnection):
+    """ Connection driven by the load generator in the reactor thread. """
+    __slots__ = ("load", "pings_left", "cycle", "cycle_time", "negotiating",
+                 "done")
+
+    def __init__(self, socket, address, reactor, load):
+        self.load = load
+        self.pings_left = load.scenario.pings
+        self.cycle = 0  # Number of the current status request
+        self.cycle_time = None  # When the current status request started
+        self.negotiating = False  # Waiting for the compression threshold
+        self.done = False
+
+        super().__init__(socket, address, reactor)
+        self.initState(state_tables,
+                       commands.command.state_handlers, [0, 0])
+        self.running = True
+
+    def begin(self):
+        """ Starts the scenario once connected. """
+        scenario = self.load.scenario
+        if scenario.compression >= 0:
+            self.commandHandle(self, ["compress", str(scenario.compression)])
+            # Set Compression is only expected in state 0, pings start after.
+            self.negotiating = self.pings_left > 0
+        if self.negotiating:
+            self.load.at(time.monotonic() + scenario.timeout,
+                         self.deadline, self.cycle)
+        elif self.pings_left > 0:
+            self.ping()
+        else:
+            self.idle()
+
+    def ping(self):
+        """ Sends a handshake, status request and ping. """
+        if self.done:
+            return
+        self.cycle += 1
+        self.cycle_time = time.monotonic()
+        self.commandHandle(self, ["ping", str(self.cycle)])
+        self.load.at(self.cycle_time + self.load.scenario.timeout,
+                     self.deadline, self.cycle)
+
+    def deadline(self, cycle):
+        if not self.done and cycle == self.cycle and (
+                self.state != 0 or self.negotiating):
+            self.fail("timeout")
+
+    def recordRtt(self, rtt):
+        self.load.rtts.append(rtt)
+        self.pings_left -= 1
+        # Runs after the pong is handled, once back in state 0.
+        if self.pings_left > 0:
+            rate = self.load.scenario.rate
+            self.load.at(self.cycle_time + (1 / rate if rate else 0),
+                         self.ping)
+        else:
+            self.load.at(time.monotonic(), self.idle)
+
+    def idle(self):
+        """ Holds the connection open before disconnecting. """
+        self.load.at(time.monotonic() + self.load.scenario.hold, self.finish)
+
+    def finish(self):
+        if not self.done:
+            self.done = True
+            self.stop()
+            self.close()
+            self.load.finished(self)
+
+    def fail(self, error):
+        if not self.done:
+            self.load.errors[error] += 1
+            self.finish()
+
+    def decode(self):
+        try:
+            super().decode()
+        except Exception as e:
+            logging.debug("Protocol error with %s: %s", self.address, e)
+            self.fail("protocol")
+
+    def eof(self):
+        self.fail("closed")
+
+
+class LoadGenerator:
+    """ Opens the connections of a Scenario and measures them. """
+
+    def __init__(self, address, scenario):
+        self.address = address
+        self.scenario = scenario
+        self.reactor = rt.Reactor()
+
+        self.timers = []  # Heap of (time, number, funct, args)
+        self.timer_count = 0
+        self.clients = {}  # Socket: LoadClient
+
+        self.started = 0  # Connections attempted
+        self.ended = 0  # Connections finished or failed
+        self.connect_times = []  # s
+        self.rtts = []  # s
+        self.errors = Counter()
+        self.start_time = None
+        self.connect_end = None  # When the last connection was established
+        self.end_time = None
+
+    def at(self, when, funct, *args):
+        """ Runs funct(*args) in the reactor thread at monotonic time when. """
+        heapq.heappush(self.timers, (when, self.timer_count, funct, args))
+        self.timer_count += 1
+
+    def run(self):
+        """ Runs the scenario, returns the report. """
+        raiseFileLimit(self.scenario.connections + 64)
+        self.start_time = time.monotonic()
+        rate = self.scenario.connect_rate
+        for i in range(self.scenario.connections):
+            self.at(self.start_time + (i / rate if rate else 0), self.connect)
+
+        try:
+            while not self.reactor.stopped:
+                timeout = None
+                if self.timers:
+                    timeout = max(0, self.timers[0][0] - time.monotonic())
+                self.reactor.poll(timeout)
+                now = time.monotonic()
+                while self.timers and self.timers[0][0] <= now:
+                    _, _, funct, args = heapq.heappop(self.timers)
+                    funct(*args)
+        except KeyboardInterrupt:
+            logging.warning("Load interrupted.")
+        finally:
+            self.end_time = time.monotonic()
+            self.reactor.poll(0)  # Closes the finished connections
+            for socket in list(self.clients):
+                socket.close()
+            self.reactor.close()
+        return self.report()
+
+    def connect(self):
+        socket = sk.socket(sk.AF_INET, sk.SOCK_STREAM)
+        socket.setblocking(0)
+        socket.setsockopt(sk.IPPROTO_TCP, sk.TCP_NODELAY, 1)
+        self.started += 1
+        error = socket.connect_ex(self.address)
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            socket.close()
+            self.connectFailed(error)
+            return
+        start = time.monotonic()
+        self.clients[socket] = None
+        self.reactor.register(socket, rt.EVENT_WRITE,
+                              lambda s, mask: self.connected(s, start))
+        self.at(start + self.scenario.timeout, self.connectDeadline, socket)
+
+    def connected(self, socket, start):
+        """ When a connecting socket is writable. """
+        error = socket.getsockopt(sk.SOL_SOCKET, sk.SO_ERROR)
+        if error:
+            self.reactor.unregister(socket)
+            del self.clients[socket]
+            socket.close()
+            self.connectFailed(error)
+            return
+
+        now = time.monotonic()
+        self.connect_times.append(now - start)
+        self.connect_end = now
+        client = LoadClient(socket, self.address, self.reactor, self)
+        self.clients[socket] = client
+        self.reactor.modify(socket, rt.EVENT_READ, self.handle)
+        client.begin()
+
+    def connectDeadline(self, socket):
+        if socket in self.clients and self.clients[socket] is None:
+            self.reactor.unregister(socket)
+            del self.clients[socket]
+            socket.close()
+            self.connectFailed(errno.ETIMEDOUT)
+
+    def connectFailed(self, error):
+        self.errors[errno.errorcode.get(error, str(error)).lower()] += 1
+        self.ended += 1
+        self.checkEnd()
+
+    def handle(self, s, mask):
+        """ When a client socket is ready. """
+        client = self.clients.get(s)
+        if client is None:
+            return
+        if mask & rt.EVENT_WRITE:
+            client.sendQueued()
+        if mask & rt.EVENT_READ:
+            try:
+                read = client.receive()
+            except BlockingIOError:
+                return
+            except OSError:
+                client.fail("reset")
+                return
+            if not read:
+                self.reactor.unregister(s)
+                client.eof()
+
+    def finished(self, client):
+        self.clients.pop(client.socket, None)
+        self.ended += 1
+        self.checkEnd()
+
+    def checkEnd(self):
+        if self.ended >= self.scenario.connections:
+            self.reactor.stop()
+
+    def report(self):
+        """ Returns the measures as a dict. """
+        connected = len(self.connect_times)
+        connect_duration = (self.connect_end or self.start_time) \
+            - self.start_time
+        duration = self.end_time - self.start_time
+        connect_times = sorted(t * 1000 for t in self.connect_times)
+        rtts = sorted(t * 1000 for t in self.rtts)
+        return {
+            "connections": self.started,
+            "connected": connected,
+            "connect_rate": connected / connect_duration
+            if connect_duration > 0 else None,
+            "connect_ms": {q: percentile(connect_times, q)
+                           for q in (50, 90, 99, 100)},
+            "pings": len(rtts),
+            "ping_rate": len(rtts) / duration if duration > 0 else None,
+            "rtt_ms": {q: percentile(rtts, q)
+                       for q in (50, 90, 99, 99.9, 100)},
+            "errors": dict(self.errors),
+            "duration": duration
+        }
+
+
+def formatReport(report):
+    """ Returns the lines of a report. """
+    def values(percentiles):
+        return ", ".join(
+            "max %.2f" % v if q == 100 else "p%s %.2f" % (q, v)
+            for q, v in percentiles.items() if v is not None) or "-"
+
+    def rate(value):
+        return "-" if value is None else "%.1f/s" % value
+
+    errors = ", ".join("%s: %s" % e for e in sorted(report["errors"].items()))
+    return [
+        "Connected %s / %s (%s)." % (report["connected"],
+                                     report["connections"],
+                                     rate(report["connect_rate"])),
+        "Connect time (ms): " + values(report["connect_ms"]),
+        "Pings: %s (%s)." % (report["pings"], rate(report["ping_rate"])),
+        "RTT (ms): " + values(report["rtt_ms"]),
+        "Errors: " + (errors or "none"),
+        "Duration: %.2f s." % report["duration"]
+    ]
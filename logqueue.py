@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+""" Logging through a bounded queue, handled by a listener thread.
+
+Logging threads only queue their records: formatting and the handlers
+(ex: the terminal) run in the listener thread. When the queue is full the
+records below WARNING are dropped and a summary of them is logged instead.
+"""
+
+import queue
+import logging
+import logging.handlers
+
+from collections import Counter
+from threading import Lock
+
+QUEUE_SIZE = 10000  # Records waiting for the listener
+WARNING_TIMEOUT = 0.1  # s a WARNING or above waits for the full queue
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """ Queues records without waiting, counting the ones dropped. """
+
+    def __init__(self, size=QUEUE_SIZE):
+        super().__init__(queue.Queue(size))
+        self.dropped = Counter()  # Level name: records dropped
+        self.drop_lock = Lock()
+
+    def prepare(self, record):
+        # Formatted by the listener (same process).
+        return record
+
+    def enqueue(self, record):
+        try:
+            if record.levelno >= logging.WARNING:
+                self.queue.put(record, timeout=WARNING_TIMEOUT)
+            else:
+                self.queue.put_nowait(record)
+        except queue.Full:
+            with self.drop_lock:
+                self.dropped[record.levelname] += 1
+
+    def takeDropped(self):
+        """ Returns and resets the counts of dropped records. """
+        with self.drop_lock:
+            dropped, self.dropped = self.dropped, Counter()
+        return dropped
+
+
+class Listener(logging.handlers.QueueListener):
+    """ Handles the records of a DroppingQueueHandler in a thread. """
+
+    def __init__(self, source, *handlers):
+        super().__init__(source.queue, *handlers, respect_handler_level=True)
+        self.source = source
+
+    def handle(self, record):
+        self.summarize()
+        super().handle(record)
+
+    def summarize(self):
+        """ Handles a record counting the records dropped since the last. """
+        dropped = self.source.takeDropped()
+        if dropped:
+            super().handle(logging.makeLogRecord({
+                "name": "logqueue",
+                "levelno": logging.WARNING,
+                "levelname": "WARNING",
+                "threadName": "Logging",
+                "msg": "%s log records dropped (%s).",
+                "args": (sum(dropped.values()),
+                         ", ".join("%s %s" % (n, level) for level, n
+                                   in sorted(dropped.items())))}))
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)  # Waits if the queue is full
+
+    def stop(self):
+        super().stop()
+        self.summarize()
+
+
+def start(handlers, level=logging.DEBUG, form=None, size=QUEUE_SIZE):
+    """ Sends the records of the root logger to handlers through a queue.
+
+    Returns the started Listener, to be stopped before exiting.
+    """
+    formatter = logging.Formatter(form)
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    source = DroppingQueueHandler(size)
+    logging.basicConfig(level=level, handlers=[source])
+    listener = Listener(source, *handlers)
+    listener.start()
+    return listener
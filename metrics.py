@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+
+""" Counters and gauges exported as JSON or Prometheus text.
+
+Metrics are created once in the module using them, ex:
+PACKETS = metrics.registry.summary("packets_bytes", "Packets.", ("id",))
+and updated on the hot path with PACKETS.inc((packet_id,), size).
+"""
+
+import os
+import json
+import time
+import socket as sk
+import logging
+
+from collections import deque
+from threading import Event, Lock, Thread
+
+FOLD_SIZE = 1024  # Pending increments of a Counter added at once
+
+
+class Counter:
+    """ Values only increasing, one for each combination of labels.
+
+    Increments are appended to a deque without lock (atomic) and added to
+    the values by batches, so the hot path stays cheap in every thread.
+    """
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {} if labels else {(): 0}  # Labels values: value
+        self.pending = deque()  # (labels values, increment)
+        self.lock = Lock()
+
+    def inc(self, key=(), value=1):
+        self.pending.append((key, value))
+        if len(self.pending) > FOLD_SIZE:
+            self.fold()
+
+    def fold(self):
+        """ Adds the pending increments to the values. """
+        with self.lock:
+            pending, values = self.pending, self.values
+            for _ in range(len(pending)):
+                key, value = pending.popleft()
+                values[key] = values.get(key, 0) + value
+
+    def total(self):
+        self.fold()
+        with self.lock:
+            return sum(self.values.values())
+
+    def collect(self):
+        self.fold()
+        with self.lock:
+            return dict(self.values)
+
+
+class Summary(Counter):
+    """ Number and sum of observed values, ex: packets and their bytes. """
+    kind = "summary"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self.values = {} if labels else {(): (0, 0)}  # Values: (count, sum)
+
+    def fold(self):
+        with self.lock:
+            pending, values = self.pending, self.values
+            for _ in range(len(pending)):
+                key, value = pending.popleft()
+                count, total = values.get(key, (0, 0))
+                values[key] = (count + 1, total + value)
+
+    def total(self):
+        self.fold()
+        with self.lock:
+            return sum(count for count, _ in self.values.values())
+
+
+class Gauge:
+    """ Values set by the code or computed by funct when collected.
+
+    funct returns a value, or a dict of values by labels values.
+    """
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), funct=None):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.funct = funct
+        self.values = {}
+        self.lock = Lock()
+
+    def set(self, value, key=()):
+        with self.lock:
+            self.values[key] = value
+
+    def collect(self):
+        if self.funct is None:
+            with self.lock:
+                return dict(self.values)
+        values = self.funct()
+        return values if isinstance(values, dict) else {(): values}
+
+
+class Rate:
+    """ Increase per second of a Counter over the last window seconds. """
+
+    def __init__(self, counter, window=10):
+        self.counter = counter
+        self.window = window
+        self.samples = deque([(time.monotonic(), counter.total())])
+        self.lock = Lock()
+
+    def __call__(self):
+        now, value = time.monotonic(), self.counter.total()
+        with self.lock:
+            self.samples.append((now, value))
+            # Keeps the most recent sample at least window seconds old.
+            while len(self.samples) > 2 \
+                    and now - self.samples[1][0] >= self.window:
+                self.samples.popleft()
+            then, previous = self.samples[0]
+        return (value - previous) / (now - then) if now > then else 0.0
+
+
+class Registry:
+    """ Metrics of the process. """
+
+    def __init__(self):
+        self.metrics = {}  # Name: metric
+        self.lock = Lock()
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(name, help, labels))
+
+    def summary(self, name, help, labels=()):
+        return self.add(Summary(name, help, labels))
+
+    def gauge(self, name, help, labels=(), funct=None):
+        return self.add(Gauge(name, help, labels, funct))
+
+    def add(self, metric):
+        """ Registers a metric, returns the one of the same name if any. """
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def collect(self):
+        """ Returns (metric, {labels values: value}) pairs. """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        result = []
+        for metric in metrics:
+            try:
+                result.append((metric, metric.collect()))
+            except Exception:
+                logging.exception("Exception in metric %s.", metric.name)
+        return result
+
+    def toDict(self):
+        """ Returns the metrics as data for JSON. """
+        data = {}
+        for metric, values in self.collect():
+            samples = []
+            for key, value in sorted(values.items(), key=str):
+                if metric.kind == "summary":
+                    value = {"count": value[0], "sum": value[1]}
+                samples.append({"labels": dict(zip(metric.labels, key)),
+                                "value": value})
+            data[metric.name] = {"type": metric.kind, "help": metric.help,
+                                 "values": samples}
+        return data
+
+    def toJson(self):
+        return json.dumps(self.toDict())
+
+    def toPrometheus(self):
+        lines = []
+        for metric, values in self.collect():
+            lines.append("# HELP %s %s" % (metric.name, metric.help))
+            lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+            lines.extend(formatSamples(metric, values))
+        return "\n".join(lines) + "\n"
+
+    def lines(self):
+        """ Returns the samples of every metric, one per line. """
+        lines = []
+        for metric, values in self.collect():
+            lines.extend(formatSamples(metric, values))
+        return lines
+
+    def export(self, form):
+        return self.toJson() if form == "json" else self.toPrometheus()
+
+
+def formatSamples(metric, values):
+    """ Returns the Prometheus text lines of the values of a metric. """
+    lines = []
+    for key, value in sorted(values.items(), key=str):
+        labels = ",".join('%s="%s"' % (label, str(v).replace('"', '\\"'))
+                          for label, v in zip(metric.labels, key))
+        labels = "{%s}" % labels if labels else ""
+        if metric.kind == "summary":
+            lines.append("%s_count%s %s" % (metric.name, labels, value[0]))
+            lines.append("%s_sum%s %s" % (metric.name, labels, value[1]))
+        else:
+            if isinstance(value, float):
+                value = round(value, 3)
+            lines.append("%s%s %s" % (metric.name, labels, value))
+    return lines
+
+
+class Exporter(Thread):
+    """ Writes the metrics to a file every interval seconds.
+
+    The file is replaced at once so readers never see a partial export.
+    """
+
+    def __init__(self, registry, path, interval=10, form="prometheus"):
+        super().__init__(name="Metrics", daemon=True)
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self.form = form
+        self.stopped = Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.dump()
+
+    def dump(self):
+        temporary = self.path + ".tmp"
+        try:
+            with open(temporary, "w") as file:
+                file.write(self.registry.export(self.form))
+            os.replace(temporary, self.path)
+        except OSError:
+            logging.exception("Exception writing metrics to %s.", self.path)
+
+    def stop(self):
+        """ Writes the metrics a last time. """
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+        self.dump()
+
+
+class SocketExporter(Thread):
+    """ Sends the metrics to every connection to a UNIX socket. """
+
+    def __init__(self, registry, path, form="prometheus"):
+        super().__init__(name="Metrics", daemon=True)
+        self.registry = registry
+        self.path = path
+        self.form = form
+
+        if os.path.exists(path):
+            os.remove(path)
+        self.socket = sk.socket(sk.AF_UNIX, sk.SOCK_STREAM)
+        self.socket.bind(path)
+        self.socket.listen()
+
+    def run(self):
+        while True:
+            try:
+                connection, _ = self.socket.accept()
+            except OSError:  # Closed
+                break
+            with connection:
+                try:
+                    connection.sendall(
+                        self.registry.export(self.form).encode("utf-8"))
+                except OSError:
+                    logging.warning("Sending metrics failed.")
+
+    def stop(self):
+        try:
+            self.socket.shutdown(sk.SHUT_RDWR)  # Wakes up accept
+        except OSError:
+            pass
+        self.socket.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+registry = Registry()
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+import time
+import logging
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Condition, Lock
+
+import profiler
+
+SATURATION_WARNING_TIME = 10  # s between saturation warnings
+
+
+class WorkerPool:
+    """ Fixed number of threads running the tasks of many connections.
+
+    Tasks of a connection run in the order they were submitted and never
+    at the same time, so its packets are handled as by its own thread.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.executor = ThreadPoolExecutor(size, "Worker")
+        self.queues = {}  # Connection: tasks waiting or running
+        self.lock = Lock()
+        self.idle = Condition(self.lock)  # Notified when nothing is pending
+
+        self.pending = 0  # Tasks submitted and not finished
+        self.warning_time = 0
+
+    def submit(self, connection, funct, *args):
+        """ Runs funct(*args) after the previous tasks of connection. """
+        with self.lock:
+            self.pending += 1
+            tasks = self.queues.get(connection)
+            if tasks is not None:
+                tasks.append((funct, args))
+                return
+            self.queues[connection] = deque([(funct, args)])
+            saturated = self.saturated()
+        self.executor.submit(self._run, connection)
+
+        if saturated and time.monotonic() - self.warning_time \
+                > SATURATION_WARNING_TIME:
+            self.warning_time = time.monotonic()
+            logging.warning("Worker pool saturated: %s tasks for %s workers.",
+                            self.pending, self.size)
+
+    def saturated(self):
+        """ Whether connections are waiting for a free worker. """
+        return len(self.queues) > self.size
+
+    def stats(self):
+        with self.lock:
+            return {"workers": self.size,
+                    "connections": len(self.queues),
+                    "pending": self.pending,
+                    "saturated": self.saturated()}
+
+    def shutdown(self):
+        """ Waits for the submitted tasks to finish. """
+        with self.lock:
+            while self.pending > 0:
+                self.idle.wait()
+        self.executor.shutdown(wait=True)
+
+    def _run(self, connection):
+        """ Runs the next task of connection. """
+        profiler.sync()
+        with self.lock:
+            funct, args = self.queues[connection][0]
+        try:
+            funct(*args)
+        except Exception:
+            logging.exception("Exception in worker.")
+
+        with self.lock:
+            self.pending -= 1
+            tasks = self.queues[connection]
+            tasks.popleft()
+            if not tasks:
+                del self.queues[connection]
+                if self.pending == 0:
+                    self.idle.notify_all()
+                return
+        # Lets the other connections run before the next task.
+        self.executor.submit(self._run, connection)
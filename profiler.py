@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+""" Profiling of every thread of the process, started on demand.
+
+"sample" mode reads the stacks of every thread at a fixed interval from a
+thread of its own (wall clock, waiting threads included) and writes them as
+collapsed stacks, the input of flamegraph.pl or speedscope.
+
+"cprofile" mode runs cProfile in every thread, each thread starting its own
+profile when it calls sync (the engine loops do), and writes pstats files.
+From Python 3.12, the first profile enabled covers every thread instead.
+"""
+
+import os
+import sys
+import time
+import pstats
+import cProfile
+import threading
+
+from collections import Counter
+
+SAMPLE_INTERVAL = 0.005  # s between samples
+MAX_DEPTH = 128  # Frames kept from the top of a stack
+SHARED_PROFILE = sys.version_info >= (3, 12)  # A cProfile for every thread
+
+current = None  # Running or stopped profiler of the last profile start
+active = None  # ThreadProfiles the threads follow in sync
+_local = threading.local()
+
+
+def frameName(code):
+    return "%s (%s:%s)" % (code.co_name, os.path.basename(code.co_filename),
+                           code.co_firstlineno)
+
+
+class SamplingProfiler(threading.Thread):
+    """ Counts the stacks of every thread every interval seconds. """
+    mode = "sample"
+    extension = ".collapsed"
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        super().__init__(name="Profiler", daemon=True)
+        self.interval = interval
+        self.stacks = Counter()  # (thread name, frames from the root): n
+        self.names = {}  # Thread ident: name
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        frames = sys._current_frames()
+        if any(ident not in self.names for ident in frames):
+            self.names = {t.ident: t.name for t in threading.enumerate()}
+        with self.lock:
+            for ident, frame in frames.items():
+                if ident == self.ident:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < MAX_DEPTH:
+                    stack.append(frameName(frame.f_code))
+                    frame = frame.f_back
+                stack.append(self.names.get(ident, str(ident)))
+                self.stacks[tuple(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+
+    def dump(self, path):
+        """ Writes the collapsed stacks, one "frame;frame count" by line. """
+        with self.lock:
+            stacks = sorted(self.stacks.items())
+        with open(path, "w") as file:
+            for stack, count in stacks:
+                file.write("%s %s\n" % (";".join(stack), count))
+
+    def summary(self, count=10):
+        """ Returns the functions running in the most thread samples. """
+        leaves = Counter()
+        with self.lock:
+            for stack, n in self.stacks.items():
+                leaves[stack[-1]] += n
+        total = max(1, sum(leaves.values()))
+        return ["%5.1f%% %s" % (100 * n / total, name)
+                for name, n in leaves.most_common(count)]
+
+
+class Snapshot:
+    """ Stats of a profile still enabled, for pstats.Stats. """
+
+    def __init__(self, profile):
+        profile.snapshot_stats()  # create_stats would disable it
+        self.stats = profile.stats
+
+    def create_stats(self):
+        pass
+
+
+class ThreadProfiles:
+    """ A cProfile profile for every thread calling sync. """
+    mode = "cprofile"
+    extension = ".pstats"
+
+    def __init__(self):
+        self.profiles = []
+        self.lock = threading.Lock()
+        self.running = False
+
+    def start(self):
+        global active
+        self.running = True
+        active = self
+        sync()
+
+    def enable(self):
+        """ Starts profiling the calling thread. """
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:  # SHARED_PROFILE, enabled by another thread.
+            return None
+        with self.lock:
+            self.profiles.append(profile)
+        return profile
+
+    def stop(self):
+        global active
+        # The other threads stop their profile when calling sync.
+        self.running = False
+        if active is self:
+            active = None
+        sync()
+        if SHARED_PROFILE:
+            # The thread which enabled it may have exited without calling
+            # sync, ex: a control socket thread.
+            with self.lock:
+                profiles = list(self.profiles)
+            for profile in profiles:
+                profile.disable()
+
+    def stats(self):
+        with self.lock:
+            profiles = list(self.profiles)
+        stats = None
+        for profile in profiles:
+            snapshot = Snapshot(profile)
+            if not snapshot.stats:
+                continue
+            if stats is None:
+                stats = pstats.Stats(snapshot)
+            else:
+                stats.add(snapshot)
+        return stats
+
+    def dump(self, path):
+        """ Writes the merged stats of every thread, for pstats. """
+        stats = self.stats()
+        if stats is None:
+            raise RuntimeError("Nothing profiled.")
+        stats.dump_stats(path)
+
+    def summary(self, count=10):
+        """ Returns the functions with the most internal time. """
+        stats = self.stats()
+        if stats is None:
+            return []
+        lines = []
+        items = sorted(stats.stats.items(), key=lambda i: -i[1][2])
+        for function, (_, calls, tottime, _, _) in items[:count]:
+            filename, line, name = function
+            if filename != "~":  # Not a built-in
+                name = "%s (%s:%s)" % (name, os.path.basename(filename), line)
+            lines.append("%8.3f s %8s calls %s" % (tottime, calls, name))
+        return lines
+
+
+def sync():
+    """ Starts or stops cProfile in the calling thread to follow active.
+
+    Called by the loops of the engines, does nothing in sample mode.
+    """
+    profiles = active
+    if getattr(_local, "profiles", None) is not profiles:
+        profile = getattr(_local, "profile", None)
+        if profile is not None:
+            profile.disable()
+        _local.profiles = profiles
+        _local.profile = profiles.enable() if profiles is not None else None
+
+
+def start(mode="sample", interval=SAMPLE_INTERVAL):
+    """ Starts a new profile, the previous one is dropped. """
+    global current
+    stop()
+    if mode == "sample":
+        current = SamplingProfiler(interval)
+    elif mode == "cprofile":
+        current = ThreadProfiles()
+    else:
+        raise ValueError("Unknown profile mode: " + str(mode))
+    current.start()
+    return current
+
+
+def stop():
+    if current is not None:
+        current.stop()
+
+
+def running():
+    if current is None:
+        return False
+    if current.mode == "sample":
+        return current.is_alive()
+    return current.running
+
+
+def dump(path=None):
+    """ Writes the current profile, returns its path. """
+    if current is None:
+        raise RuntimeError("No profile started.")
+    if path is None:
+        path = "profile-%s-%s%s" % (os.getpid(),
+                                    time.strftime("%Y%m%d-%H%M%S"),
+                                    current.extension)
+    current.dump(path)
+    return path
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import selectors
+import socket as sk
+
+from collections import deque
+
+import timers
+import profiler
+
+EVENT_READ = selectors.EVENT_READ
+EVENT_WRITE = selectors.EVENT_WRITE
+
+
+class Reactor:
+    """ Dispatches socket events to callbacks.
+
+    Uses the best selector of the platform (epoll on Linux) so registering
+    and unregistering sockets is O(1) and waiting does not depend on the
+    number of sockets. Other threads can wake the loop up through a socket
+    pair instead of waiting for a timeout. Timers of its TimerWheel run in
+    the loop thread.
+    """
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.calls = deque()
+        self.stopped = False
+        self.woken = False  # A wake up is pending
+        self.paused = {}  # Socket unregistered by modify: callback
+        self.timers = timers.TimerWheel(wakeup=self.wakeup)
+
+        self.wake_r, self.wake_w = sk.socketpair()
+        self.wake_r.setblocking(0)
+        self.wake_w.setblocking(0)
+        self.selector.register(self.wake_r, EVENT_READ, self._readWakeup)
+
+    def register(self, socket, events, callback):
+        """ Calls callback(socket, events) when socket is ready. """
+        self.selector.register(socket, events, callback)
+
+    def modify(self, socket, events, callback=None):
+        """ Changes the events waited for, keeps the callback if None.
+
+        Without events the socket is unregistered (ex: reads paused), the
+        callback being kept until events are given again.
+        """
+        try:
+            if callback is None:
+                callback = self.paused.get(socket) \
+                    or self.selector.get_key(socket).data
+            if not events:
+                self.selector.unregister(socket)
+                self.paused[socket] = callback
+            elif socket in self.paused:
+                del self.paused[socket]
+                self.selector.register(socket, events, callback)
+            else:
+                self.selector.modify(socket, events, callback)
+        except (KeyError, ValueError):  # Unregistered or closed
+            pass
+
+    def unregister(self, socket):
+        self.paused.pop(socket, None)
+        try:
+            self.selector.unregister(socket)
+        except (KeyError, ValueError):  # Already unregistered or closed
+            pass
+
+    def wakeup(self):
+        """ Interrupts the current poll, can be called from any thread. """
+        if self.woken:
+            return
+        self.woken = True
+        try:
+            self.wake_w.send(b"\x00")
+        except OSError:  # Buffer full, a wake up is already pending.
+            pass
+
+    def callSoon(self, funct, *args):
+        """ Runs funct(*args) in the loop thread. """
+        self.calls.append((funct, args))
+        self.wakeup()
+
+    def callLater(self, delay, funct, *args):
+        """ Runs funct(*args) in the loop thread in delay seconds.
+
+        Returns a timers.Timer, which can be cancelled.
+        """
+        return self.timers.schedule(delay, funct, *args)
+
+    def poll(self, timeout=None):
+        """ Waits for events and dispatches them. """
+        profiler.sync()
+        tick = self.timers.timeout()
+        if tick is not None and (timeout is None or tick < timeout):
+            timeout = tick
+        for key, mask in self.selector.select(timeout):
+            # A previous callback may have unregistered the socket.
+            if self.selector.get_map().get(key.fd) is key:
+                key.data(key.fileobj, mask)
+        self.timers.advance()
+        while self.calls:
+            funct, args = self.calls.popleft()
+            funct(*args)
+
+    def run(self):
+        """ Polls until stopped. """
+        while not self.stopped:
+            self.poll()
+
+    def stop(self):
+        self.stopped = True
+        self.wakeup()
+
+    def close(self):
+        self.selector.close()
+        self.wake_r.close()
+        self.wake_w.close()
+
+    def _readWakeup(self, socket, mask):
+        try:
+            while socket.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        except OSError:
+            logging.exception("Exception in wake up.")
+        # Only after reading, a wake up sent meanwhile must stay readable.
+        self.woken = False
@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -*-
+
+""" Packet schemas compiled once into encode and decode functions.
+
+A schema is a list of field types as used by Client.pack and
+Client.waitForPacket, ex: ["VarInt", ("String", 255), "Unsigned Short"].
+Consecutive fixed size fields are read and written by a single struct.
+
+Arrays of numbers ("Int Array", "Long Array", "Double Array" and
+"VarInt Array") are prefixed by their number of values (VarInt) and
+encoded at once: by NumPy if installed, decoding to NumPy arrays, by the
+array module otherwise, decoding to array.array.
+"""
+
+import sys
+
+from array import array
+from functools import lru_cache
+from struct import Struct, error as StructError
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+VARINT_TABLE_SIZE = 1 << 14  # Values encoded without a loop (2 bytes)
+SWAP_BYTES = sys.byteorder == "little"  # array.array is in native order
+
+# Fixed size types with their struct format.
+FIXED_TYPES = {
+    "Boolean": "?",
+    "Byte": "b",
+    "Unsigned Byte": "B",
+    "Short": "h",
+    "Unsigned Short": "H",
+    "Int": "i",
+    "Long": "q",
+    "Float": "f",
+    "Double": "d"
+}
+
+# Number of bits of VarInt types.
+VARINT_TYPES = {
+    "VarInt": 32,
+    "VarLong": 64
+}
+
+# Arrays of fixed size values with their NumPy dtype and array typecode.
+ARRAY_TYPES = {
+    "Int Array": (">i4", "i"),
+    "Long Array": (">i8", "q"),
+    "Double Array": (">f8", "d")
+}
+
+
+def twosComp(value, bits):
+    """ Compute the 2's complement of int value. """
+    if (value & (1 << (bits - 1))) != 0:
+        value = value - (1 << bits)
+    return value
+
+
+def _encodeVarInt(value):
+    """ Encodes a positive value 7 bits at a time. """
+    byte = bytearray()
+    while value > 0x7F:
+        byte.append(value & 0x7F | 0x80)
+        value >>= 7
+    byte.append(value)
+    return bytes(byte)
+
+
+VARINT_TABLE = [_encodeVarInt(i) for i in range(VARINT_TABLE_SIZE)]
+VARINT_MASKS = {size: (1 << 32 * size) - 1 for size in (1, 2)}
+FLOAT_STRUCTS = {4: Struct(">f"), 8: Struct(">d")}
+
+
+def writeBoolean(bool):
+    return b'\x01' if bool else b'\x00'
+
+
+def writeInt(value, size):
+    return (value & ((1 << 8 * size) - 1)).to_bytes(size, "big")
+
+
+def writeFloat(value, size):
+    assert size in [4, 8]
+    return FLOAT_STRUCTS[size].pack(value)
+
+
+def writeVarInt(value, size):
+    """ Returns the VarInt representation of value. """
+    if 0 <= value < VARINT_TABLE_SIZE:
+        return VARINT_TABLE[value]
+    return _encodeVarInt(value & VARINT_MASKS[size])
+
+
+def writeString(value):
+    value = value.encode("utf-8")
+    return writeVarInt(len(value), 1) + value
+
+
+def readVarInt(buffer, bits):
+    """ Returns a VarInt value and its size from a ReceiveBuffer. """
+    data, pos = buffer.data, buffer.pos
+    value, i = 0, 0
+    while True:
+        if pos + i >= len(data):
+            raise RuntimeError("Incomplete VarInt.")
+        byte = data[pos + i]
+        value |= (byte & 0x7F) << 7 * i
+        i += 1
+        if not byte & 0x80:
+            break
+    if i > (bits + 6) // 7:
+        raise RuntimeError("VarInt longer than expected.")
+    buffer.pos += i
+    return twosComp(value, bits), i
+
+
+def writeArray(values, dtype, typecode):
+    """ Returns the count and the big-endian bytes of values. """
+    if numpy is not None:
+        data = numpy.asarray(values, dtype=dtype)
+        if data.ndim != 1:
+            raise RuntimeError("Array of %s dimensions." % data.ndim)
+        return writeVarInt(len(data), 1) + data.tobytes()
+    data = array(typecode, values)
+    if SWAP_BYTES:
+        data.byteswap()
+    return writeVarInt(len(data), 1) + data.tobytes()
+
+
+def readArray(data, dtype, typecode):
+    """ Returns the values of big-endian bytes, in native order. """
+    if numpy is not None:
+        return numpy.frombuffer(data, dtype).astype(dtype[1:])  # Copied
+    values = array(typecode)
+    values.frombytes(data)
+    if SWAP_BYTES:
+        values.byteswap()
+    return values
+
+
+def writeVarInts(values):
+    """ Returns the count and the VarInts of 32 bits values. """
+    if numpy is None:
+        return writeVarInt(len(values), 1) + b"".join(
+            [writeVarInt(value, 1) for value in values])
+
+    values = numpy.asarray(values, dtype=numpy.int64)
+    if values.ndim != 1:
+        raise RuntimeError("Array of %s dimensions." % values.ndim)
+    values = values & 0xFFFFFFFF  # Negative values as 5 bytes
+    sizes = numpy.ones(len(values), dtype=numpy.int64)
+    for bits in range(7, 32, 7):
+        sizes += values >= 1 << bits
+    ends = numpy.cumsum(sizes)
+    data = numpy.empty(ends[-1] if len(ends) else 0, dtype=numpy.uint8)
+    starts = ends - sizes
+    # Byte i of every VarInt having one, the last without 0x80.
+    for i in range(5):
+        has = sizes > i
+        byte = (values[has] >> 7 * i) & 0x7F
+        byte |= (sizes[has] > i + 1) * 0x80
+        data[starts[has] + i] = byte
+    return writeVarInt(len(values), 1) + data.tobytes()
+
+
+def readVarInts(buffer, count, left):
+    """ Returns count VarInts of 32 bits, at most left bytes long. """
+    if numpy is None:
+        values = array("i")
+        for _ in range(count):
+            if left <= 0:
+                raise RuntimeError("Received more than expected.")
+            value, size = readVarInt(buffer, 32)
+            values.append(value)
+            left -= size
+        if left < 0:
+            raise RuntimeError("Received more than expected.")
+        return values
+
+    data = numpy.frombuffer(buffer.data, numpy.uint8,
+                            min(left, len(buffer)), buffer.pos)
+    ends = numpy.flatnonzero(data < 0x80)[:count]  # Last byte of each
+    if len(ends) < count:
+        raise RuntimeError("Incomplete VarInt Array.")
+    if count == 0:
+        return numpy.empty(0, dtype=numpy.int32)
+    starts = numpy.empty(count, dtype=numpy.int64)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    sizes = ends - starts + 1
+    if sizes.max() > 5:
+        raise RuntimeError("VarInt longer than expected.")
+    values = numpy.zeros(count, dtype=numpy.int64)
+    for i in range(5):
+        has = sizes > i
+        values[has] |= (data[starts[has] + i].astype(numpy.int64)
+                        & 0x7F) << 7 * i
+    buffer.pos += int(ends[-1]) + 1
+    return values.astype(numpy.uint32).view(numpy.int32)
+
+
+class Schema:
+    """ Encoder and decoder of the fields of a packet. """
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.encoders = []  # (funct(*values), number of values)
+        self.decoders = []  # funct(buffer, result, left)
+
+        run = ""  # Struct format of the current fixed size fields
+        for n, t in enumerate(fields):
+            name, param = t if isinstance(t, tuple) else (t, None)
+            if name in FIXED_TYPES:
+                run += FIXED_TYPES[name]
+                continue
+            if run:
+                self._addStruct(run)
+                run = ""
+            self._addField(n, name, param)
+        if run:
+            self._addStruct(run)
+
+        if len(self.encoders) == 1:
+            # Values are passed as is to the only encoder.
+            self.encode = self._encodeSingle
+
+    def encode(self, values):
+        """ Returns the bytes of the values of the fields.
+
+        Raises RuntimeError when a value doesn't fit its fixed size type.
+        """
+        parts = []
+        i = 0
+        try:
+            for funct, count in self.encoders:
+                parts.append(funct(*values[i:i + count]))
+                i += count
+        except (StructError, OverflowError) as e:
+            raise self._encodeError(values, i, count, e)
+        return b"".join(parts)
+
+    def _encodeSingle(self, values):
+        try:
+            return self.encoders[0][0](*values)
+        except (StructError, OverflowError) as e:
+            raise self._encodeError(values, 0, len(self.fields), e)
+
+    def _encodeError(self, values, start, count, error):
+        """ Returns the RuntimeError of fields failing to be encoded. """
+        names = [t[0] if isinstance(t, tuple) else t
+                 for t in self.fields[start:start + count]]
+        return RuntimeError("Can't encode %s as %s: %s." % (
+            list(values[start:start + count]), ", ".join(names), error))
+
+    def decode(self, buffer, left):
+        """ Reads the left bytes of a packet from a ReceiveBuffer. """
+        result = []
+        start = buffer.pos
+        for funct in self.decoders:
+            funct(buffer, result, left - (buffer.pos - start))
+
+        left -= buffer.pos - start
+        if left < 0:
+            raise RuntimeError("Received more than expected (%s)." % -left)
+        assert left == 0  # Assert all data is used
+
+        return result
+
+    def _addStruct(self, form):
+        struct = Struct(">" + form)
+        self.encoders.append((struct.pack, len(form)))
+
+        def decode(buffer, result, left):
+            if struct.size > left:
+                raise RuntimeError("Received more than expected.")
+            result.extend(buffer.unpackFrom(struct))
+        self.decoders.append(decode)
+
+    def _addField(self, n, name, param):
+        if name in VARINT_TYPES:
+            bits = VARINT_TYPES[name]
+            size = bits // 32
+            self.encoders.append((lambda x: writeVarInt(x, size), 1))
+            self.decoders.append(
+                lambda buffer, result, left:
+                result.append(readVarInt(buffer, bits)[0]))
+
+        elif name == "UUID":
+            self.encoders.append((lambda x: writeInt(x, 16), 1))
+
+            def decode(buffer, result, left):
+                result.append(int.from_bytes(buffer.read(16), "big"))
+            self.decoders.append(decode)
+
+        elif name == "String":
+            max_length = param
+
+            def decode(buffer, result, left):
+                length, _ = readVarInt(buffer, 32)
+                if max_length is not None and length > max_length:
+                    raise RuntimeError("String longer than expected")
+                if length > len(buffer):
+                    raise RuntimeError("Incomplete String.")
+                result.append(str(buffer.read(length), "utf-8"))
+            self.encoders.append((writeString, 1))
+            self.decoders.append(decode)
+
+        elif name in ARRAY_TYPES:
+            dtype, typecode = ARRAY_TYPES[name]
+            itemsize = array(typecode).itemsize
+            self.encoders.append(
+                (lambda x: writeArray(x, dtype, typecode), 1))
+
+            def decode(buffer, result, left):
+                count, size = readVarInt(buffer, 32)
+                if count < 0 or count * itemsize > left - size:
+                    raise RuntimeError("Received more than expected.")
+                result.append(readArray(buffer.read(count * itemsize),
+                                        dtype, typecode))
+            self.decoders.append(decode)
+
+        elif name == "VarInt Array":
+            self.encoders.append((writeVarInts, 1))
+
+            def decode(buffer, result, left):
+                count, size = readVarInt(buffer, 32)
+                if count < 0 or count > left - size:
+                    raise RuntimeError("Received more than expected.")
+                result.append(readVarInts(buffer, count, left - size))
+            self.decoders.append(decode)
+
+        elif name == "Byte Array":
+            self.encoders.append((lambda x: x, 1))
+            self.decoders.append(self._byteArrayDecoder(n, param))
+
+        else:
+            raise RuntimeError("Unexpected type: " + str(name))
+
+    def _byteArrayDecoder(self, n, param):
+        """ Determines the size of the Byte Array from param. """
+        # Fixed size (ex: param=256).
+        if not isinstance(param, str):
+            def length(result, left):
+                return param
+        # Size determined by the last data (ex: param="lastVarInt")
+        elif len(param) > 4 and param.startswith("last"):
+            if n > 0 and self.fields[n - 1] == param[4:]:
+                def length(result, left):
+                    return result[-1]
+            else:
+                raise RuntimeError("Last type doesn't match")
+        # Until the end of the packet (param="left").
+        elif param == "left":
+            def length(result, left):
+                return left
+        else:
+            raise RuntimeError("Unexpected parameter: " + str(param))
+
+        def decode(buffer, result, left):
+            size = length(result, left)
+            if size > left:
+                raise RuntimeError("Received more than expected (%s)."
+                                   % (size - left))
+            result.append(buffer.read(size))
+        return decode
+
+
+@lru_cache(maxsize=None)
+def compile(fields):
+    """ Returns the Schema of a tuple of field types. """
+    return Schema(fields)
@@ -1,19 +1,57 @@
 # -*- coding: utf-8 -*-
 
-import select
+import time
+import errno
 import socket as sk
+import signal
 import logging
+import argparse
+import asyncio
+import threading
 
 import common
-import terminal
+import framing
+import metrics
+import workers
+import logqueue
+import profiler
+import broadcast
+import pool as wp
+import timers
+import latency
+import transfer
+import reactor as rt
+import control
 
 import commands.server
 
 MAX_HOST = 10
-MAX_LOOP_TIME = 0.1  # s
+MAX_TOPICS = 32  # Topics a client can subscribe to
+ACCEPT_BACKOFF = 0.1  # s without accepting when out of file descriptors
+RTT_QUANTILES = (50, 90, 99, 99.9, 100)  # Percentiles shown and exported
 server_ip = ("", 23456)  # ("192.168.1.40", 23456)
+max_clients = MAX_HOST
+backlog = MAX_HOST + 2
+reuse_port = False  # Lets worker processes bind the same port
+compression_threshold = 256  # Bytes from which packets are compressed
 running = False
+wakeup = None  # Interrupts the engine waiting for events
+engine = "threads"
+worker_pool = None
+worker_processes = None
 hosts = {}
+broadcaster = broadcast.Broadcaster()
+metrics_file = None  # Path where the metrics are written periodically
+metrics_socket = None  # Path of a UNIX socket sending the metrics
+metrics_interval = 10  # s
+metrics_format = "prometheus"  # Or "json"
+keepalive_interval = 15  # s without data before a keepalive ping, 0: never
+pong_timeout = 30  # s to answer a keepalive ping
+handshake_timeout = 10  # s to finish the exchange started by a handshake
+idle_timeout = 0  # s without data before disconnecting, 0: never
+max_frame = common.MAX_FRAME  # Bytes of a received packet
+buffer_budget = common.BUFFER_BUDGET  # Bytes buffered before pausing reads
+transfer_dir = None  # Directory of the files received, None: refused
 
 server_version = ("test", -1)
 motd = "Hello World !"
@@ -29,66 +67,356 @@ propreties = {
     "description": {
         "text": motd}
 }
+status_cache = commands.server.StatusCache(propreties)
+
+
+def connectionStates():
+    """ Returns the number of connections in each state. """
+    states = {}
+    for h in list(hosts.values()):
+        states[(h.state,)] = states.get((h.state,), 0) + 1
+    return states
+
+
+def fleetRtt():
+    """ Returns the Histogram of the RTTs of every online client (µs). """
+    return latency.fleetHistogram(h.rtt for h in list(hosts.values()))
+
+
+def rttQuantiles():
+    """ Returns the RTT percentiles of the online clients in seconds. """
+    histogram = fleetRtt()
+    if not histogram.count:
+        return {}
+    return {("%g" % (q / 100),): histogram.percentile(q) / 1000000
+            for q in RTT_QUANTILES}
+
+
+def queueDepths():
+    """ Returns the largest and total received data waiting. """
+    depths = [h.queueDepth() for h in list(hosts.values())]
+    return {("max",): max(depths, default=0), ("total",): sum(depths)}
+
+
+ACCEPTED = metrics.registry.counter(
+    "connections_accepted_total", "Connections accepted.")
+REFUSED = metrics.registry.counter(
+    "connections_refused_total", "Connections refused (max clients).")
+ACCEPT_ERRORS = metrics.registry.counter(
+    "accept_errors_total", "Connections which failed to be accepted.")
+EXPIRED = metrics.registry.counter(
+    "connections_expired_total", "Connections closed by a deadline.",
+    ("reason",))
+metrics.registry.gauge(
+    "accept_rate", "Connections accepted per second.",
+    funct=metrics.Rate(ACCEPTED))
+metrics.registry.gauge(
+    "connections", "Connections by state.", ("state",), connectionStates)
+metrics.registry.gauge(
+    "rtt_seconds", "Round trip times of the pings of the online clients.",
+    ("quantile",), rttQuantiles)
+metrics.registry.gauge(
+    "receive_queue_depth", "Received data waiting to be decoded per client.",
+    ("stat",), queueDepths)
+metrics.registry.gauge(
+    "worker_pool_pending", "Tasks waiting or running on the worker pool.",
+    funct=lambda: worker_pool.pending if worker_pool else 0)
 
 
 def commandInput(term, text):
-    """ Called when the terminal receives a user input. """
-    global running, hosts
+    """ Called when the terminal receives a user input.
+
+    Returns the result of the command as a dict (for the control socket),
+    None if the command is unknown.
+    """
+    global running
 
     command = text.split(" ")
     assert len(command) > 0
     command[0] = command[0].strip().lower()
 
     logging.debug("Command: %s", " ".join(command))
-    term.appendHistory(" ".join(command))
+    if term:
+        term.appendHistory(" ".join(command))
 
     if command[0] == "stop":  # Stops the server.
         running = False
+        if wakeup:
+            wakeup()
+        return {"stopping": True}
+
+    elif worker_processes:  # Commands are run by every worker.
+        worker_processes.command(text)
+        return {"workers": len(worker_processes.processes)}
 
     elif command[0] == "list":  # Lists the online clients.
         logging.info("%s clients online:", len(hosts))
         try:
             assert len(command) == 2
             state = int(command[1])
-            i = 0
         except (AssertionError, ValueError):
             state = None
-        for h in hosts.values():
+        clients = []
+        for h in list(hosts.values()):
             if state is None:
                 logging.info("%s in state %s.", h.address, h.state)
             elif state == h.state:
                 logging.info("%s.", h.address)
-                i += 1
+            else:
+                continue
+            clients.append({"address": list(h.address), "state": h.state,
+                            "topics": sorted(h.topics)})
         if state is not None:
-            logging.info("%s clients in state %s.", i, state)
+            logging.info("%s clients in state %s.", len(clients), state)
+        return {"online": len(hosts), "clients": clients}
 
     elif command[0] == "ping":   # Sends a ping to every online client.
         try:
-            assert len(command) == 2
+            assert len(command) in [2, 3]
             ping_data = int(command[1])
         except (AssertionError, ValueError):
             ping_data = int(common.time.time() * 1000)
+        topic = command[2] if len(command) == 3 else None
         logging.info("Sending ping: %s", ping_data)
+
+        targets = broadcaster.select(list(hosts.values()), 0, topic)
+        ping_time = time.monotonic()
+        for h in targets:
+            h.ping_data = ping_data
+            h.ping_time = ping_time
+        results = broadcaster.send(targets, 1, [("Long", ping_data)])
         i = 0
-        for h in hosts.values():
-            if h.state == 0:
-                h.ping_data = ping_data
-                h.ping_time = common.time.time()
-                h.pack(1, [("Long", h.ping_data)])  # Payload
+        failed = []
+        for h, delivered in results:
+            if delivered:
                 i += 1
+            else:
+                logging.warning("Ping to %s failed.", h.address)
+                failed.append(list(h.address))
         logging.info("%s/%s pings sent.", i, len(hosts))
+        return {"ping": ping_data, "sent": i, "online": len(hosts),
+                "failed": failed}
 
-
-class Client(common.Client):
-    """ Handles client-server synchronization. """
+    elif command[0] == "rtt":  # Shows the RTTs and the slowest clients.
+        try:
+            count = int(command[1])
+        except (IndexError, ValueError):
+            count = 10
+        histogram = fleetRtt()
+        percentiles = {"%g" % q: histogram.percentile(q) / 1000
+                       for q in RTT_QUANTILES if histogram.count}
+        logging.info("RTT of %s pongs (ms): %s", histogram.count,
+                     ", ".join("p%s %.2f" % p for p in percentiles.items())
+                     or "-")
+        measured = [h for h in list(hosts.values()) if len(h.rtt)]
+        measured.sort(key=lambda h: h.rtt.average, reverse=True)
+        clients = []
+        for h in measured[:count]:
+            clients.append({"address": list(h.address),
+                            "average": h.rtt.average * 1000,
+                            "p99": h.rtt.percentile(99) * 1000,
+                            "last": h.rtt.last * 1000,
+                            "pongs": len(h.rtt)})
+            logging.info("%s: average %.2f ms, p99 %.2f ms, last %.2f ms "
+                         "(%s pongs).", h.address, h.rtt.average * 1000,
+                         h.rtt.percentile(99) * 1000, h.rtt.last * 1000,
+                         len(h.rtt))
+        return {"pongs": histogram.count, "percentiles_ms": percentiles,
+                "slowest": clients}
+
+    elif command[0] == "transfers":  # Shows the transfers in progress.
+        transfers = []
+        for h in list(hosts.values()):
+            if h.transfers is None:
+                continue
+            for t in h.transfers.all():
+                status = t.status()
+                logging.info("%s %s %s: %s / %s bytes.", h.address,
+                             status["direction"], status["name"],
+                             status["done"], status["size"])
+                transfers.append(dict(status, address=list(h.address)))
+        if not transfers:
+            logging.info("No transfers.")
+        return {"transfers": transfers}
+
+    elif command[0] == "stats":  # Shows the metrics.
+        for line in metrics.registry.lines():
+            logging.info(line)
+        return metrics.registry.toDict()
+
+    elif command[0] == "profile":  # Profiles every thread of the server.
+        action = command[1] if len(command) > 1 else ""
+        if action == "start":
+            mode = command[2] if len(command) > 2 else "sample"
+            try:
+                interval = float(command[3]) / 1000
+            except (IndexError, ValueError):
+                interval = profiler.SAMPLE_INTERVAL
+            try:
+                profiler.start(mode, interval)
+                logging.info("Profiling started (%s).", mode)
+            except ValueError as e:
+                logging.warning("%s", e)
+                return {"error": str(e)}
+        elif action == "stop":
+            profiler.stop()
+            logging.info("Profiling stopped.")
+        elif action == "dump":
+            try:
+                path = profiler.dump(command[2] if len(command) > 2 else None)
+            except (RuntimeError, OSError) as e:
+                logging.warning("Profile not written: %s", e)
+                return {"error": "Profile not written: %s" % e}
+            else:
+                logging.info("Profile written to %s.", path)
+                summary = profiler.current.summary()
+                for line in summary:
+                    logging.info(line)
+                return {"path": path, "summary": summary}
+        elif profiler.running():
+            logging.info("Profiling (%s).", profiler.current.mode)
+        else:
+            logging.info("Not profiling.")
+        return {"profiling": profiler.running(),
+                "mode": profiler.current.mode if profiler.current else None}
+
+    elif command[0] == "pool":  # Shows the worker pool usage.
+        if worker_pool is None:
+            logging.info("No worker pool (engine %s).", engine)
+            return {"engine": engine, "workers": 0}
+        stats = worker_pool.stats()
+        logging.info("%s workers, %s tasks pending for %s clients.",
+                     stats["workers"], stats["pending"],
+                     stats["connections"])
+        if stats["saturated"]:
+            logging.warning("Worker pool saturated.")
+        return dict(stats, engine=engine)
+
+    if command[0]:
+        logging.warning("Unknown command: %s", command[0])
+    return None
+
+
+class Host:
+    """ Server side of a connection, shared by every engine.
+
+    Its attributes are slots of the engine classes, a mixin can't have
+    slots next to the slots of the connection.
+    """
+    __slots__ = ()
+    attributes = ("timers", "timer", "last_received", "state_time",
+                  "keepalive_time", "rtt", "server_propreties",
+                  "status_cache", "server_compression")
 
     def __init__(self, *args, **kwargs):
+        self.timers = None  # TimerWheel checking the deadlines
+        self.timer = None
+        self.last_received = time.monotonic()  # Set by the engine
+        self.state_time = self.last_received  # When the state changed
+        self.keepalive_time = None  # When the unanswered keepalive was sent
+        self.rtt = latency.RttStats()
+
         super().__init__(*args, **kwargs)
 
         self.server_propreties = propreties  # Create reference
+        self.status_cache = status_cache
+        self.server_compression = compression_threshold
+        self.decoder.max_frame = max_frame
+        self.buffer_budget = buffer_budget
 
         # Command handlers can be used to send command as client.
-        self.initState(commands.server.state_setups, False, [0, 0])
+        self.initState(commands.server.state_tables, False, [0, 0])
+
+    def setState(self, state):
+        self.state_time = time.monotonic()
+        super().setState(state)
+
+    def startTimers(self, wheel):
+        """ Checks the deadlines of the connection on a TimerWheel. """
+        self.timers = wheel
+        self.scheduleCheck(time.monotonic())
+
+    def scheduleCheck(self, now):
+        deadline = self.nextDeadline(now)
+        if deadline is not None:
+            self.timer = self.timers.schedule(max(0, deadline - now),
+                                              self.checkDeadlines)
+
+    def nextDeadline(self, now):
+        """ Returns when checkDeadlines must run next, None if never. """
+        deadlines = []
+        if self.state and handshake_timeout:
+            deadlines.append(self.state_time + handshake_timeout)
+        if self.keepalive_time is not None:
+            deadlines.append(self.keepalive_time + pong_timeout)
+        elif keepalive_interval:
+            # Pings are only sent in state 0, checked again later.
+            deadlines.append(self.last_received + keepalive_interval
+                             if self.state == 0 else now + keepalive_interval)
+        if idle_timeout:
+            deadlines.append(self.last_received + idle_timeout)
+        return min(deadlines, default=None)
+
+    def checkDeadlines(self):
+        """ Sends keepalive pings and closes late connections.
+
+        Runs in the thread of the engine loop.
+        """
+        self.timer = None
+        if not self.running:
+            return
+        now = time.monotonic()
+        if self.state and handshake_timeout \
+                and now - self.state_time >= handshake_timeout:
+            self.expire("handshake")
+        elif self.keepalive_time is not None \
+                and now - self.keepalive_time >= pong_timeout:
+            self.expire("pong")
+        elif idle_timeout and now - self.last_received >= idle_timeout:
+            self.expire("idle")
+        else:
+            if keepalive_interval and self.keepalive_time is None \
+                    and self.state == 0 \
+                    and now - self.last_received >= keepalive_interval:
+                self.keepAlive(now)
+            self.scheduleCheck(now)
+
+    def keepAlive(self, now):
+        """ Sends a ping the client must answer within pong_timeout. """
+        self.keepalive_time = now
+        self.ping_data = int(time.time() * 1000)
+        self.ping_time = time.monotonic()
+        self.pack(1, [("Long", self.ping_data)])  # Payload
+
+    def recordRtt(self, rtt):
+        self.keepalive_time = None
+        self.rtt.record(rtt)
+
+    def acceptTransfer(self, name, size):
+        if transfer_dir is None:
+            return None
+        path = transfer.receivePath(transfer_dir, name)
+        return transfer.FileSink(path) if path is not None else None
+
+    def subscribe(self, topic):
+        """ Receives the packets broadcast to topic. """
+        if topic in self.topics:
+            return
+        if len(self.topics) >= MAX_TOPICS:
+            logging.warning("%s subscribed to too many topics.", self.address)
+            return
+        logging.debug("%s subscribed to %s.", self.address, topic)
+        broadcaster.subscribe(self, topic)
+
+    def unsubscribe(self, topic):
+        logging.debug("%s unsubscribed from %s.", self.address, topic)
+        broadcaster.unsubscribe(self, topic)
+
+    def expire(self, reason):
+        """ Closes the connection, the engine handles it as a disconnect. """
+        logging.warning("Closing %s: %s timeout.", self.address, reason)
+        EXPIRED.inc((reason,))
+        self.abort()
 
     def connected(self):
         """ When the client connects """
@@ -100,94 +428,584 @@ class Client(common.Client):
         if self.address in propreties["clients"]["sample"]:
             propreties["clients"]["sample"].remove(self.address)
         propreties["clients"]["online"] -= 1
-        self.socket.close()
+        status_cache.invalidate()
+        hosts.pop(self.socket, None)
+        broadcaster.unsubscribe(self)
+        transfer.cancelAll(self)
+        if self.timer is not None:
+            self.timer.cancel()
+        self.close()
+
+
+class Client(Host, common.Client):
+    """ Handles client-server synchronization in a thread. """
+
+
+class PoolClient(Host, common.ReactorConnection):
+    """ Handles client-server synchronization on a worker pool.
+
+    The reactor thread splits received data into packets, which are
+    decoded and handled by the pool in the order they were received.
+    """
+    __slots__ = Host.attributes + ("pool", "submitted_bytes",
+                                   "handled_bytes", "splitter")
+
+    def __init__(self, socket, address, reactor, pool):
+        self.pool = pool
+        self.submitted_bytes = 0  # Written by the reactor thread only
+        self.handled_bytes = 0  # Written by the worker of the client only
+        super().__init__(socket, address, reactor)
+        # Splits the packets in the reactor thread, the worker decodes their
+        # body with decoder.
+        self.splitter = framing.FrameDecoder(self.decoder.max_frame)
+
+    def start(self):
+        self.running = True
+
+    def receive(self):
+        read = self.splitter.receiveFrom(self.socket, self.read_size.size)
+        self.read_size.update(read)
+        if read:
+            self.split()
+        return read
+
+    def received(self, data):
+        self.splitter.feed(data)
+        self.split()
+
+    def split(self):
+        """ Submits every complete packet received to the pool. """
+        body = self.splitter.nextFrame()
+        while body is not None:
+            # A view of the received data, decoded in place by the worker.
+            self.submitted_bytes += len(body)
+            self.pool.submit(self, self.handle, body)
+            body = self.splitter.nextFrame()
+
+    def pendingInput(self):
+        # The incomplete packet is bounded by max_frame.
+        return self.submitted_bytes - self.handled_bytes
+
+    def eof(self):
+        self.pool.submit(self, self.end)
+
+    def queueDepth(self):
+        return len(self.pool.queues.get(self, ()))
+
+    def handle(self, body):
+        """ Decodes and handles a packet in a worker. """
+        if not self.running:
+            return
+        try:
+            self.handleFrame(body)
+        except Exception as e:
+            common.countError(e)
+            logging.exception("Exception in run.")
+            self.running = False
+        self.handled_bytes += len(body)
+        self.consumed()
+        if not self.running:
+            self.disconnected()
+
+    def end(self):
+        """ Stops the client after its packets are handled. """
+        if self.running:
+            self.running = False
+            self.disconnected()
+
+
+class AsyncClient(Host, common.Connection):
+    """ Handles client-server synchronization in an asyncio task. """
+    __slots__ = Host.attributes + ("reader", "writer", "loop", "loop_thread",
+                                   "buffer_budget", "scheduled_writes")
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.scheduled_writes = 0  # Writes waiting in the loop
+        super().__init__(writer.get_extra_info("socket"),
+                         writer.get_extra_info("peername"))
+
+    async def run(self):
+        """ Decodes received data until the connection stops. """
+        try:
+            self.running = True
+            # Reads wait while the data to send is over the budget.
+            self.writer.transport.set_write_buffer_limits(
+                high=self.buffer_budget)
+            while self.running:
+                data = await self.reader.read(common.MAX_READ_SIZE)
+                if not data:  # The client disconnected.
+                    break
+                self.last_received = time.monotonic()
+                profiler.sync()
+                self.feed(data)
+                await self.writer.drain()
+        except (ConnectionAbortedError,
+                ConnectionRefusedError,
+                ConnectionResetError):
+            logging.warning("Connection failed with %s.", self.address)
+        except Exception as e:
+            common.countError(e)
+            logging.exception("Exception in run.")
+        finally:
+            self.running = False
+            self.disconnected()
+
+    def write(self, data):
+        with self.send_lock:
+            # Commands are run from the terminal thread, their writes are
+            # scheduled in the loop: the next writes are scheduled after
+            # them to keep the order of the frames.
+            if threading.get_ident() == self.loop_thread \
+                    and not self.scheduled_writes:
+                self.writer.write(data)
+            else:
+                self.scheduled_writes += 1
+                self.loop.call_soon_threadsafe(self.writeScheduled, data)
+
+    def writeScheduled(self, data):
+        with self.send_lock:
+            self.scheduled_writes -= 1
+            self.writer.write(data)
+
+    def writeParts(self, parts):
+        data = []
+        for p in parts:
+            if isinstance(p, common.FileRegion):
+                data.append(p.read())
+                p.release()
+            else:
+                data.append(p)
+        self.write(b"".join(data))
 
+    def close(self):
+        self.writer.close()
 
-def main():
-    global running, hosts
+
+def main(pool_size=None):
+    """ Runs the clients in a thread each, or on a pool of pool_size. """
+    global running, wakeup, worker_pool
+
+    reactor = rt.Reactor()
+    pool = wp.WorkerPool(pool_size) if pool_size else None
+    worker_pool = pool
+
+    def accept(server, mask):
+        """ When the server receives a new connection. """
+        try:
+            client, address = server.accept()
+        except BlockingIOError:
+            return
+        except OSError as e:
+            ACCEPT_ERRORS.inc()
+            if e.errno in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS,
+                           errno.ENOMEM):
+                # The connection stays in the backlog, the listener is
+                # polled again once descriptors may have been released.
+                logging.warning("Can't accept connections: %s", e)
+                reactor.unregister(server)
+                reactor.callLater(ACCEPT_BACKOFF, reactor.register,
+                                  server, rt.EVENT_READ, accept)
+            else:  # Ex: ECONNABORTED, the connection is already closed.
+                logging.warning("Failed to accept a connection: %s", e)
+            return
+        if len(hosts) >= max_clients:
+            logging.warning("Refused %s: %s clients online.",
+                            address, len(hosts))
+            REFUSED.inc()
+            client.close()
+            return
+        ACCEPTED.inc()
+        client.setblocking(0)
+        # Frames are already coalesced by the send queue (as asyncio does).
+        client.setsockopt(sk.IPPROTO_TCP, sk.TCP_NODELAY, 1)
+        if pool:
+            hosts[client] = PoolClient(client, address, reactor, pool)
+        else:
+            hosts[client] = Client(client, address, reactor)
+        reactor.register(client, rt.EVENT_READ, handle)
+        hosts[client].start()
+        hosts[client].startTimers(reactor.timers)
+        propreties["clients"]["online"] += 1
+        propreties["clients"]["sample"].append(address)
+        status_cache.invalidate()
+
+    def handle(s, mask):
+        """ When a client socket is ready. """
+        client = hosts.get(s)
+        if client is None:  # Disconnected, waiting to be unregistered.
+            return
+        if mask & rt.EVENT_WRITE:
+            client.sendQueued()
+        if mask & rt.EVENT_READ:
+            receive(s, client)
+
+    def receive(s, client):
+        """ When a client socket receives something. """
+        read = 0
+        try:
+            # Socket can be closed when disconnecting with exception
+            if client.running:
+                read = client.receive()
+        except BlockingIOError:
+            return
+        except (ConnectionAbortedError,
+                ConnectionRefusedError,
+                ConnectionResetError):
+            logging.warning("Connection failed with %s.", client.address)
+        except OSError as e:  # Ex: ETIMEDOUT, only this client stops.
+            logging.warning("Connection failed with %s: %s",
+                            client.address, e)
+        except (common.FrameTooLarge, RuntimeError, ValueError) as e:
+            # Packets split in the reactor (pool), only this client stops.
+            common.countError(e)
+            logging.warning("Disconnecting %s: %s", client.address, e)
+        if read:  # If 0: the client disconnected.
+            client.last_received = time.monotonic()
+            client.checkBudget()
+        else:
+            reactor.unregister(s)
+            client.eof()
 
     # Creating server.
     server = sk.socket(sk.AF_INET, sk.SOCK_STREAM)
     server.setblocking(0)
+    # Restarts while connections closed by the server are in TIME_WAIT.
+    server.setsockopt(sk.SOL_SOCKET, sk.SO_REUSEADDR, 1)
+    if reuse_port:
+        server.setsockopt(sk.SOL_SOCKET, sk.SO_REUSEPORT, 1)
     server.bind(server_ip)
-    server.listen(MAX_HOST + 2)
-
-    inputs = [server]
-    outputs = []
+    server.listen(backlog)
+    reactor.register(server, rt.EVENT_READ, accept)
 
+    propreties["clients"]["max"] = max_clients
+    status_cache.invalidate()
     running = True
+    wakeup = reactor.stop
     logging.info("Listening for connections...")
 
-    # Loops when a socket is ready or every MAX_LOOP_TIME seconds.
-    while inputs and running:
-        readable, writable, exceptional = select.select(
-            inputs, outputs, inputs, MAX_LOOP_TIME)
-
-        # When a socket receives something.
-        for s in readable:
-            if s is server:  # If the socket is the server (new connection).
-                client, address = s.accept()
-                client.setblocking(0)
-                inputs.append(client)
-                hosts[client] = Client(client, address)
-                hosts[client].start()
-                propreties["clients"]["online"] += 1
-                propreties["clients"]["sample"].append(address)
-            else:
-                data = None
-                try:
-                    # Socket can be closed when disconnecting with exception
-                    if hosts[s].running:
-                        data = s.recv(1024)
-                except (ConnectionAbortedError,
-                        ConnectionRefusedError,
-                        ConnectionResetError):
-                    logging.warning("Connection failed with %s.",
-                                    s.getpeername())
-                if data:  # If data is None / b'': the client disconnected.
-                    hosts[s].data_queue.put(data)  # TODO: public method
-                else:
-                    inputs.remove(s)
-                    if s in outputs:
-                        outputs.remove(s)
-                    hosts[s].stop()
-                    del hosts[s]
-
-        # When a socket is ready to send something.
-        for s in writable:
-            logging.debug("%s writable", s.getpeername())
-
-        # When a socket encounters an exception.
-        for s in exceptional:
-            inputs.remove(s)
-            if s in outputs:
-                outputs.remove(s)
-            logging.warning("Socket exceptional condition for %s.",
-                            s.getpeername())
-            hosts[s].stop()
-            del hosts[s]
+    # Waits for socket events until stopped.
+    try:
+        reactor.run()
+    finally:
+        running = False
+        wakeup = None
 
     # Iterates over the hosts to disconnect them.
-    for s in list(hosts):
-        logging.info("Disconnecting %s.", s.getpeername())
-        hosts[s].stop()
-        del hosts[s]
+    for client in list(hosts.values()):
+        logging.info("Disconnecting %s.", client.address)
+        if pool:
+            pool.submit(client, client.end)
+        else:
+            client.stop()
+    if pool:
+        pool.shutdown()
+
+    reactor.poll(0)  # Closes the sockets.
+    reactor.close()
+    server.close()
+
+
+async def handleConnection(reader, writer, wheel):
+    """ Runs a client connected to the asyncio server. """
+    client = AsyncClient(reader, writer)
+    ACCEPTED.inc()
+    hosts[client.socket] = client
+    propreties["clients"]["online"] += 1
+    propreties["clients"]["sample"].append(client.address)
+    status_cache.invalidate()
+    client.startTimers(wheel)
+    await client.run()
+
+
+async def runTimers(wheel, scheduled):
+    """ Advances a TimerWheel in the asyncio loop.
+
+    scheduled is an asyncio.Event set when the first timer is scheduled,
+    waited for while the wheel is empty.
+    """
+    while True:
+        scheduled.clear()  # Before checking, a timer scheduled next sets it.
+        timeout = wheel.timeout()
+        if timeout is None:
+            await scheduled.wait()
+            continue
+        await asyncio.sleep(timeout)
+        wheel.advance()
+
+
+async def mainAsync():
+    """ Runs every connection as a coroutine of a single thread. """
+    global running, wakeup
+
+    loop = asyncio.get_running_loop()
+    stopped = asyncio.Event()
+    scheduled = asyncio.Event()
+    tasks = set()
+
+    def stop():
+        loop.call_soon_threadsafe(stopped.set)
+
+    def timerScheduled():
+        loop.call_soon_threadsafe(scheduled.set)
+
+    wheel = timers.TimerWheel(wakeup=timerScheduled)
+
+    def connect(reader, writer):
+        if len(hosts) >= max_clients:
+            logging.warning("Refused %s: %s clients online.",
+                            writer.get_extra_info("peername"), len(hosts))
+            writer.close()
+            return
+        task = asyncio.ensure_future(handleConnection(reader, writer, wheel))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    server = await asyncio.start_server(
+        connect, server_ip[0] or None, server_ip[1], backlog=backlog,
+        reuse_port=reuse_port or None)
+
+    propreties["clients"]["max"] = max_clients
+    status_cache.invalidate()
+    running = True
+    wakeup = stop
+    timer_task = asyncio.ensure_future(runTimers(wheel, scheduled))
+    logging.info("Listening for connections...")
+
+    # Commands are received from the terminal thread.
+    try:
+        await stopped.wait()
+    finally:
+        running = False
+        wakeup = None
+        timer_task.cancel()
 
     server.close()
+    await server.wait_closed()
+
+    for task in list(tasks):
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def startMetrics():
+    """ Starts exporting the metrics, returns the exporters. """
+    exporters = []
+    if metrics_file:
+        exporters.append(metrics.Exporter(
+            metrics.registry, metrics_file, metrics_interval, metrics_format))
+    if metrics_socket:
+        exporters.append(metrics.SocketExporter(
+            metrics.registry, metrics_socket, metrics_format))
+    for exporter in exporters:
+        exporter.start()
+    return exporters
+
+
+def runEngine(pool_size=4):
+    """ Runs the server with the selected engine. """
+    exporters = startMetrics()
+    try:
+        if engine == "asyncio":
+            asyncio.run(mainAsync())
+        elif engine == "pool":
+            main(pool_size)
+        else:
+            main()
+    finally:
+        for exporter in exporters:
+            exporter.stop()
+
+
+def runWorker(index, shared, pipe, pool_size):
+    """ Runs the engine in a worker process, sharing the port. """
+    global status_cache, reuse_port, worker_processes
+    global metrics_file, metrics_socket
+
+    status_cache = workers.SharedStatusCache(
+        propreties, shared, index, status_cache.min_interval)
+    reuse_port = True
+    worker_processes = None  # Inherited from the parent process
+    # Each worker exports its own metrics.
+    if metrics_file:
+        metrics_file += ".%s" % index
+    if metrics_socket:
+        metrics_socket += ".%s" % index
+
+    def receiveCommands():
+        """ Commands sent by the parent process. """
+        while True:
+            try:
+                text = pipe.recv()
+            except EOFError:
+                break
+            try:
+                commandInput(None, text)
+            except Exception:
+                logging.exception("Exception in command.")
+
+    threading.Thread(target=receiveCommands, daemon=True).start()
+    runEngine(pool_size)
+
+
+def mainWorkers(count, pool_size):
+    """ Runs count server processes, accepting on the same port. """
+    global running, wakeup, worker_processes
+
+    worker_processes = workers.WorkerProcesses(
+        count, lambda *args: runWorker(*args, pool_size))
+    worker_processes.start()
+
+    stopped = threading.Event()
+    running = True
+    wakeup = stopped.set
+    logging.info("Started %s workers.", count)
+
+    # Waits for the stop command or for every worker to stop.
+    try:
+        while running and worker_processes.alive():
+            stopped.wait(1)
+    finally:
+        running = False
+        wakeup = None
+        worker_processes.stop()
+
+
+def stopSignal(signum, frame):
+    """ Stops the server on SIGTERM or SIGINT (headless). """
+    commandInput(None, "stop")
 
 
 if __name__ == "__main__":
-    # Setting up "graphics".
-    term = terminal.Terminal(commandInput)
-    logging.basicConfig(
-        level=logging.DEBUG,
-        format='[%(levelname)-5s] (%(threadName)-10s) %(message)s',
-        handlers=[terminal.TerminalHandler(term)])  # logging.StreamHandler()
+    parser = argparse.ArgumentParser(description="Runs the server.")
+    parser.add_argument("--host", default=server_ip[0],
+                        help="address to listen on, all by default")
+    parser.add_argument("--port", type=int, default=server_ip[1])
+    parser.add_argument("--engine", choices=["threads", "asyncio", "pool"],
+                        default=engine,
+                        help="one thread per client, a single asyncio loop "
+                             "or a fixed pool of threads")
+    parser.add_argument("--pool-size", type=int, default=4,
+                        help="threads of the pool engine")
+    parser.add_argument("--max-clients", type=int, default=max_clients,
+                        help="connections accepted at the same time")
+    parser.add_argument("--backlog", type=int, default=None,
+                        help="pending connections queued by the system")
+    parser.add_argument("--status-interval", type=float, default=0,
+                        help="minimum seconds between status rebuilds")
+    parser.add_argument("--compression-threshold", type=int,
+                        default=compression_threshold,
+                        help="bytes from which packets are compressed when "
+                             "requested, -1 to refuse")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="server processes sharing the port")
+    parser.add_argument("--metrics-file",
+                        help="file where the metrics are written "
+                             "periodically")
+    parser.add_argument("--metrics-socket",
+                        help="UNIX socket sending the metrics on connection")
+    parser.add_argument("--metrics-interval", type=float,
+                        default=metrics_interval,
+                        help="seconds between writes of the metrics file")
+    parser.add_argument("--metrics-format", choices=["prometheus", "json"],
+                        default=metrics_format)
+    parser.add_argument("--keepalive", type=float,
+                        default=keepalive_interval,
+                        help="seconds without data before pinging a client, "
+                             "0 to never ping")
+    parser.add_argument("--pong-timeout", type=float, default=pong_timeout,
+                        help="seconds for a client to answer a keepalive "
+                             "ping before being disconnected")
+    parser.add_argument("--handshake-timeout", type=float,
+                        default=handshake_timeout,
+                        help="seconds for a client to finish the exchange "
+                             "started by a handshake, 0 for no limit")
+    parser.add_argument("--idle-timeout", type=float, default=idle_timeout,
+                        help="seconds without data before disconnecting a "
+                             "client, 0 for no limit")
+    parser.add_argument("--max-frame", type=int, default=max_frame,
+                        help="bytes of a received packet, larger ones "
+                             "disconnect the client")
+    parser.add_argument("--buffer-budget", type=int, default=buffer_budget,
+                        help="bytes received or to send of a client from "
+                             "which its reads are paused")
+    parser.add_argument("--transfer-dir",
+                        help="directory where the files sent by clients are "
+                             "written, refused by default")
+    parser.add_argument("--headless", action="store_true",
+                        help="runs without terminal (curses is not needed), "
+                             "stopped by SIGTERM or the control socket")
+    parser.add_argument("--log-file",
+                        help="file where the records are written when "
+                             "headless, stderr by default")
+    parser.add_argument("--log-level", default="INFO",
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="minimum level of the records when headless")
+    parser.add_argument("--control-socket",
+                        help="UNIX socket running the commands of its "
+                             "connections, replied in JSON")
+    args = parser.parse_args()
+
+    server_ip = (args.host, args.port)
+    engine = args.engine
+    compression_threshold = args.compression_threshold
+    max_clients = args.max_clients
+    backlog = args.backlog or max_clients + 2
+    status_cache.min_interval = args.status_interval
+    metrics_file = args.metrics_file
+    metrics_socket = args.metrics_socket
+    metrics_interval = args.metrics_interval
+    metrics_format = args.metrics_format
+    keepalive_interval = args.keepalive
+    pong_timeout = args.pong_timeout
+    handshake_timeout = args.handshake_timeout
+    idle_timeout = args.idle_timeout
+    max_frame = args.max_frame
+    buffer_budget = args.buffer_budget
+    transfer_dir = args.transfer_dir
+
+    log_format = '[%(levelname)-5s] (%(threadName)-10s) %(message)s'
+    if args.workers:
+        log_format = '[%(levelname)-5s] (%(processName)s/%(threadName)-10s) ' \
+            '%(message)s'
+    term = None
+    if args.headless:
+        log_handler = logging.FileHandler(args.log_file) if args.log_file \
+            else logging.StreamHandler()
+        log_listener = logqueue.start(
+            [log_handler], getattr(logging, args.log_level),
+            '%(asctime)s ' + log_format)
+        signal.signal(signal.SIGTERM, stopSignal)
+        signal.signal(signal.SIGINT, stopSignal)
+    else:
+        import terminal  # Only needed with the terminal (curses).
+
+        # Setting up "graphics".
+        term = terminal.Terminal(commandInput)
+        # Records are handled by a thread, the network threads never wait.
+        log_listener = logqueue.start(
+            [terminal.TerminalHandler(term)], logging.DEBUG, log_format)
+
+    control_server = None
+    if args.control_socket:
+        control_server = control.ControlServer(
+            args.control_socket, lambda text: commandInput(None, text))
+        control_server.start()
 
     # Main program.
     try:
-        main()
+        if args.workers:
+            mainWorkers(args.workers, args.pool_size)
+        else:
+            runEngine(args.pool_size)
     except Exception:
         logging.exception("Exception in \"main\".")
 
-    term.stop()
+    if control_server:
+        control_server.stop()
+    log_listener.stop()
+    if term:
+        term.stop()
@@ -1,10 +1,14 @@
 # -*- coding: utf-8 -*-
 
+import time
 import curses
 import logging
+from collections import deque
 from threading import Thread
 
 MAX_HISTORY_SIZE = 100
+SCROLLBACK_SIZE = 1000  # Lines kept
+FRAME_RATE = 30  # Maximum redraws per second for new lines
 
 
 class TerminalHandler(logging.StreamHandler):
@@ -21,6 +25,12 @@ class TerminalHandler(logging.StreamHandler):
 
 
 class Terminal(Thread):
+    """ Curses terminal with a command prompt below the displayed lines.
+
+    Only the terminal thread uses curses: display queues the lines, which
+    are drawn by the terminal thread at most FRAME_RATE times per second.
+    """
+
     def __init__(self, callback=lambda *args: None, press=lambda *args: None):
         Thread.__init__(self)
         self.callback = callback
@@ -30,7 +40,8 @@ class Terminal(Thread):
         self.prompt_text = ">"
         self.prompt_x = len(self.prompt_text)
 
-        self.lines = []
+        self.lines = deque(maxlen=SCROLLBACK_SIZE)
+        self.pending = deque(maxlen=SCROLLBACK_SIZE)  # Lines not drawn yet
         self.history = []
 
         self.input_text = ""
@@ -43,6 +54,12 @@ class Terminal(Thread):
         self.history_pos = 0
         self.insert = True
 
+        self.stdscr = None
+        self.log = None  # Window of the lines
+        self.prompt = None  # Window of the prompt, at the bottom
+        self.size = None  # Size of the last full draw
+        self.draw_time = 0
+
     def run(self):
         """ Starts the terminal. """
         self.running = True
@@ -55,17 +72,12 @@ class Terminal(Thread):
         self.display("Press any key to exit...")
 
     def display(self, *msg, sep=" "):
-        """ Displays the concatenated msg in the terminal with separator. """
+        """ Displays the concatenated msg in the terminal with separator.
+
+        Can be called from any thread, never waits for the terminal.
+        """
         for line in sep.join([str(m) for m in msg]).split("\n"):
-            line = line.replace("\r", "")
-            if self.width > 0:
-                for i in range(0, len(line), self.width):
-                    self.lines.append(line[i:i + self.width])
-            else:
-                self.lines.append(line)
-        while len(self.lines) > self.height - 1 and self.height > 0:
-            self.lines.pop(0)
-        self._draw()
+            self.pending.append(line.replace("\r", ""))
 
     def appendHistory(self, text):
         self.history.append(str(text))
@@ -80,6 +92,7 @@ class Terminal(Thread):
         cursor_x = self.prompt_x
 
         stdscr.keypad(True)
+        stdscr.timeout(1000 // FRAME_RATE)  # Draws new lines meanwhile
 
         stdscr.clear()
         stdscr.refresh()
@@ -87,7 +100,10 @@ class Terminal(Thread):
         while self.running:
             self.height, self.width = stdscr.getmaxyx()
 
-            if k == curses.KEY_RIGHT:
+            if k == -1 or k == curses.KEY_RESIZE:  # Only drawing
+                pass
+
+            elif k == curses.KEY_RIGHT:
                 cursor_x += 1
             elif k == curses.KEY_LEFT:
                 cursor_x -= 1
@@ -168,22 +184,69 @@ class Terminal(Thread):
 
             self.cursor_x = cursor_x
             self.cursor_y = self.height - 1
-            self._draw()
+            # New lines alone are drawn at most FRAME_RATE times a second.
+            self._draw(k != -1)
             if self.running:
                 k = stdscr.getch()
 
-    def _draw(self):
-        self.stdscr.clear()
-        self.height, self.width = self.stdscr.getmaxyx()
-
-        for i, l in enumerate(self.lines):
-            self.stdscr.addstr(i, 0, l)  # TODO: Fix resizing.
-
-        self.stdscr.addstr(self.height - 1, 0,
-                           self.prompt_text + self.input_text)
-
-        self.stdscr.move(self.cursor_y, self.cursor_x)
-        self.stdscr.refresh()
+        # Shows the last lines until a key is pressed.
+        self._draw(True)
+        stdscr.timeout(-1)
+        stdscr.getch()
+
+    def _wrap(self, line):
+        """ Returns the rows of a line on the terminal width. """
+        width = max(1, self.width)
+        return [line[i:i + width] for i in range(0, len(line), width)] or [""]
+
+    def _draw(self, force=False):
+        """ Draws the new lines and the prompt. """
+        now = time.monotonic()
+        if not force and (not self.pending
+                          or now - self.draw_time < 1 / FRAME_RATE):
+            return
+        self.draw_time = now
+
+        new = []
+        while self.pending:
+            new.append(self.pending.popleft())
+        self.lines.extend(new)
+
+        size = self.stdscr.getmaxyx()
+        self.height, self.width = size
+        rows = max(1, self.height - 1)
+        if size != self.size:
+            # Full draw of the last lines in new windows.
+            self.size = size
+            self.stdscr.erase()
+            self.stdscr.noutrefresh()
+            self.log = curses.newwin(rows, self.width, 0, 0)
+            self.log.scrollok(True)
+            self.log.idlok(True)  # Scrolls with the terminal capabilities
+            self.prompt = curses.newwin(1, self.width, self.height - 1, 0)
+            new = self.lines
+        if new:
+            # Only the rows still visible are written, scrolling the window.
+            visible = deque(maxlen=rows)
+            for line in new:
+                visible.extend(self._wrap(line))
+            for row in visible:
+                self.log.scroll()
+                self._addstr(self.log, rows - 1, row)
+            self.log.noutrefresh()
+
+        # Refreshed last to leave the cursor in the prompt.
+        self.prompt.erase()
+        self._addstr(self.prompt, 0, self.prompt_text + self.input_text)
+        self.prompt.move(0, self.cursor_x)
+        self.prompt.noutrefresh()
+        curses.doupdate()
+
+    def _addstr(self, window, y, text):
+        try:
+            window.addstr(y, 0, text)
+        except curses.error:  # Writing the bottom right corner
+            pass
 
 
 if __name__ == "__main__":
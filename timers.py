@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+""" Hashed timer wheel for the deadlines of many connections.
+
+Timers are kept in the slot of the tick they expire at, modulo the number
+of slots: scheduling and cancelling are O(1) whatever the number of timers,
+and advancing only looks at the slots of the ticks elapsed. Timers expire
+at the first tick after their delay, so tick bounds their precision.
+"""
+
+import math
+import time
+import logging
+
+from threading import Lock
+
+TICK = 0.1  # s
+SLOTS = 512  # Ticks of a turn of the wheel
+
+
+class Timer:
+    """ A function scheduled on a TimerWheel. """
+    __slots__ = ("wheel", "tick", "funct", "args")
+
+    def __init__(self, wheel, tick, funct, args):
+        self.wheel = wheel
+        self.tick = tick  # Number of the tick it expires at
+        self.funct = funct
+        self.args = args
+
+    def cancel(self):
+        """ Prevents the timer from running, can be called from any thread. """
+        self.wheel.cancel(self)
+
+
+class TimerWheel:
+    """ Runs functions after delays, when advanced by an event loop.
+
+    Timers can be scheduled and cancelled from any thread, they run in the
+    thread calling advance. wakeup is called when the first timer is
+    scheduled, so a loop waiting without timeout can start advancing.
+    """
+
+    def __init__(self, tick=TICK, slots=SLOTS, wakeup=None):
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        self.wakeup = wakeup
+        self.start = time.monotonic()
+        self.current = 0  # Next tick to expire
+        self.count = 0  # Timers scheduled
+        self.lock = Lock()
+
+    def __len__(self):
+        return self.count
+
+    def schedule(self, delay, funct, *args):
+        """ Runs funct(*args) in delay seconds, returns the Timer. """
+        when = time.monotonic() + delay - self.start
+        with self.lock:
+            tick = max(math.ceil(when / self.tick), self.current)
+            timer = Timer(self, tick, funct, args)
+            self.slots[tick % len(self.slots)].add(timer)
+            self.count += 1
+            first = self.count == 1
+        if first and self.wakeup is not None:
+            self.wakeup()
+        return timer
+
+    def cancel(self, timer):
+        with self.lock:
+            slot = self.slots[timer.tick % len(self.slots)]
+            if timer in slot:
+                slot.remove(timer)
+                self.count -= 1
+
+    def timeout(self):
+        """ Returns the seconds until the next tick, None without timers. """
+        if self.count == 0:
+            return None
+        next_time = self.start + self.current * self.tick
+        return max(0, next_time - time.monotonic())
+
+    def advance(self):
+        """ Runs the timers expired since the last call. """
+        if self.count == 0:
+            return
+        expired = []
+        with self.lock:
+            last = self._elapsed()
+            # A whole turn looks at every slot, ex: after a long callback.
+            ticks = min(last - self.current + 1, len(self.slots))
+            for i in range(ticks):
+                slot = self.slots[(self.current + i) % len(self.slots)]
+                for timer in [t for t in slot if t.tick <= last]:
+                    slot.remove(timer)
+                    expired.append(timer)
+            self.current = max(self.current, last + 1)
+            self.count -= len(expired)
+
+        for timer in expired:
+            try:
+                timer.funct(*timer.args)
+            except Exception:
+                logging.exception("Exception in timer.")
+
+    def _elapsed(self):
+        """ Returns the number of the last tick started. """
+        return int((time.monotonic() - self.start) / self.tick)
@@ -0,0 +1,415 @@
+# -*- coding: utf-8 -*-
+
+""" Streaming transfers of files and large buffers over a connection.
+
+A transfer is sent as chunk packets, the sender staying at most window
+bytes ahead of the offset acknowledged by the receiver, so neither side
+holds more than a window of it in memory. Chunks of files are sent from
+disk with os.sendfile when the connection isn't compressed.
+
+The receiver acknowledges the bytes its sink has taken: a FileSink writes
+them to disk and resumes a transfer of the same name from the bytes already
+written, a ChunkIterator passes them to another thread.
+
+Packets, in state 0 in both directions:
+0x03 Transfer Start: VarInt id, String name, VarLong size.
+0x04 Transfer Chunk: VarInt id, VarLong offset, Byte Array data.
+0x05 Transfer Ack: VarInt id, VarLong offset (-1 when refused).
+"""
+
+import os
+import queue
+import logging
+
+from threading import Condition, Lock
+
+import common
+import metrics
+from schema import writeVarInt
+
+CHUNK_SIZE = 65536  # Bytes of data of a chunk packet
+WINDOW = 1048576  # Bytes sent and not acknowledged yet
+PART_SUFFIX = ".part"  # Files being received
+
+TRANSFER_START = 0x03
+TRANSFER_CHUNK = 0x04
+TRANSFER_ACK = 0x05
+
+TRANSFER_BYTES = metrics.registry.counter(
+    "transfer_bytes_total", "Bytes of transfers.", ("direction",))
+
+_lock = Lock()  # Creation of the Transfers of a connection
+
+
+class TransferError(Exception):
+    """ When a transfer stops before the end. """
+
+
+class Transfers:
+    """ Transfers of a connection in each direction, by id. """
+
+    def __init__(self):
+        self.outgoing = {}
+        self.incoming = {}
+        self.next_id = 0
+        self.lock = Lock()
+
+    def all(self):
+        with self.lock:
+            return list(self.outgoing.values()) + list(self.incoming.values())
+
+
+def transfersOf(connection):
+    if connection.transfers is None:
+        with _lock:
+            if connection.transfers is None:
+                connection.transfers = Transfers()
+    return connection.transfers
+
+
+class Outgoing:
+    """ A file or a buffer sent in chunks.
+
+    progress(outgoing), if given, is called after each acknowledgement.
+    """
+
+    def __init__(self, connection, name, source, window=WINDOW,
+                 chunk_size=CHUNK_SIZE, progress=None):
+        self.connection = connection
+        self.id = None
+        self.name = name
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            self.data = memoryview(source).cast("B")
+            self.file = None
+            self.size = len(self.data)
+        else:
+            self.data = None
+            self.file = open(source, "rb")
+            self.size = os.fstat(self.file.fileno()).st_size
+        self.window = window
+        self.chunk_size = chunk_size
+        self.progress = progress
+
+        self.offset = None  # Next byte sent, once the receiver answered
+        self.acked = 0  # Bytes taken by the receiver
+        self.queued = 0  # FileRegions in the send queue, using the file
+        self.done = False
+        self.error = None
+        self.condition = Condition()
+
+    def start(self):
+        # 0x03 Transfer Start
+        self.connection.pack(TRANSFER_START, [
+            ("VarInt", self.id),  # Transfer id
+            ("String", self.name),  # Name
+            ("VarLong", self.size)  # Size
+        ])
+
+    def acknowledged(self, offset):
+        """ Sends the next chunks once offset is taken by the receiver. """
+        with self.condition:
+            if self.done:
+                return
+            if offset < 0:
+                self.finish("Refused by %s." % (self.connection.address,))
+            elif offset > self.size:
+                self.finish("Acknowledged past the end.")
+            else:
+                if self.offset is None:  # Resumes after the bytes received
+                    self.offset = offset
+                self.acked = max(self.acked, offset)
+                if self.acked >= self.size:
+                    self.finish()
+                else:
+                    self.pump()
+        if self.progress is not None:
+            self.progress(self)
+
+    def pump(self):
+        while self.offset < self.size \
+                and self.offset - self.acked < self.window:
+            count = min(self.chunk_size, self.size - self.offset)
+            self.sendChunk(self.offset, count)
+            self.offset += count
+
+    def sendChunk(self, offset, count):
+        # 0x04 Transfer Chunk
+        body = writeVarInt(TRANSFER_CHUNK, 1) \
+            + writeVarInt(self.id, 1) \
+            + writeVarInt(offset, 2)  # Offset
+        connection = self.connection
+        with connection.send_lock:  # Framed as the packets queued before
+            threshold = connection.compression_threshold
+            if self.data is not None:
+                data = self.data[offset:offset + count]
+            elif threshold >= 0 or not common.SENDFILE:
+                data = common.FileRegion(self.file, offset, count).read()
+            else:
+                data = common.FileRegion(self.file, offset, count,
+                                         self.regionReleased)
+                self.queued += 1
+
+            if threshold >= 0:
+                parts = [common.frameBody(body + data, threshold)]
+            else:
+                parts = [writeVarInt(len(body) + count, 1) + body, data]
+            connection.countSent(TRANSFER_CHUNK, sum(len(p) for p in parts))
+            connection.writeParts(parts)
+        TRANSFER_BYTES.inc(("sent",), count)
+
+    def regionReleased(self):
+        """ Called once a FileRegion is sent or dropped by the queue. """
+        with self.condition:
+            self.queued -= 1
+            close = self.done and self.queued == 0
+        if close:
+            self.file.close()
+
+    def finish(self, error=None):
+        with self.condition:
+            if self.done:
+                return
+            self.done = True
+            self.error = error
+            self.condition.notify_all()
+            # Else closed when the last FileRegion queued is released.
+            close = self.file is not None and self.queued == 0
+        transfers = self.connection.transfers
+        with transfers.lock:
+            transfers.outgoing.pop(self.id, None)
+        if close:
+            self.file.close()
+        if error is None:
+            logging.info("Sent %s (%s bytes) to %s.", self.name, self.size,
+                         self.connection.address)
+        else:
+            logging.warning("Sending %s to %s failed: %s", self.name,
+                            self.connection.address, error)
+
+    def wait(self, timeout=None):
+        """ Waits for the end of the transfer, raises TransferError. """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.done, timeout):
+                raise TimeoutError("Transfer of %s not finished." % self.name)
+        if self.error is not None:
+            raise TransferError(self.error)
+
+    def status(self):
+        return {"id": self.id, "name": self.name, "direction": "sent",
+                "size": self.size, "done": self.acked}
+
+
+class Incoming:
+    """ A transfer received in chunks, passed to a sink. """
+
+    def __init__(self, connection, transfer_id, name, size, sink):
+        self.connection = connection
+        self.id = transfer_id
+        self.name = name
+        self.size = size
+        self.sink = sink
+        self.lock = Lock()
+        self.offset = sink.open(self)  # Next byte expected
+        self.taken = self.offset  # Bytes taken by the sink
+
+    def start(self):
+        if self.offset >= self.size:  # Received before
+            self.finish()
+        self.acknowledge(self.offset)
+
+    def chunk(self, offset, data):
+        if offset != self.offset or offset + len(data) > self.size:
+            self.acknowledge(-1)
+            self.finish("Chunk at %s, expecting %s." % (offset, self.offset))
+            return
+        self.offset += len(data)
+        TRANSFER_BYTES.inc(("received",), len(data))
+        taken = self.sink.write(data)
+        if self.offset >= self.size:
+            self.finish()
+        if taken:
+            self.release(len(data))
+
+    def release(self, count):
+        """ Called by the sink when it has taken count bytes. """
+        with self.lock:
+            self.taken += count
+            taken = self.taken
+        self.acknowledge(taken)
+
+    def acknowledge(self, offset):
+        # 0x05 Transfer Ack
+        self.connection.pack(TRANSFER_ACK, [
+            ("VarInt", self.id),  # Transfer id
+            ("VarLong", offset)  # Offset
+        ])
+
+    def finish(self, error=None):
+        transfers = self.connection.transfers
+        with transfers.lock:
+            if transfers.incoming.pop(self.id, None) is None:
+                return  # Already finished
+        self.sink.close(error)
+        if error is None:
+            logging.info("Received %s (%s bytes) from %s.", self.name,
+                         self.size, self.connection.address)
+        else:
+            logging.warning("Receiving %s from %s failed: %s", self.name,
+                            self.connection.address, error)
+
+    def status(self):
+        return {"id": self.id, "name": self.name, "direction": "received",
+                "size": self.size, "done": self.offset}
+
+
+class FileSink:
+    """ Writes a transfer to path, through path + PART_SUFFIX until complete.
+
+    A transfer of the same path resumes after the bytes of the part file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def open(self, incoming):
+        """ Returns the offset the transfer starts from. """
+        self.file = open(self.path + PART_SUFFIX, "ab")
+        offset = self.file.tell()
+        if offset > incoming.size:  # Not the same file, starting again
+            self.file.truncate(0)
+            offset = 0
+        return offset
+
+    def write(self, data):
+        """ Returns True as data is taken at once. """
+        self.file.write(data)
+        return True
+
+    def close(self, error):
+        self.file.close()
+        if error is None:
+            os.replace(self.path + PART_SUFFIX, self.path)
+
+
+class ChunkIterator:
+    """ Passes the chunks of a transfer to the thread iterating it.
+
+    Chunks are acknowledged as they are taken, the sender waiting for the
+    iteration when it is slower.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.incoming = None
+
+    def open(self, incoming):
+        self.incoming = incoming
+        return 0
+
+    def write(self, data):
+        self.queue.put(bytes(data))  # A view of the received data
+        return False
+
+    def close(self, error):
+        self.queue.put(None if error is None else TransferError(error))
+
+    def __iter__(self):
+        """ Yields the chunks as bytes, raises TransferError. """
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                return
+            if isinstance(chunk, TransferError):
+                raise chunk
+            self.incoming.release(len(chunk))
+            yield chunk
+
+
+def receivePath(directory, name):
+    """ Returns the path of a file received in directory, None if invalid.
+    """
+    name = os.path.basename(name.replace("\\", "/"))
+    if name in ("", ".", "..") or name.endswith(PART_SUFFIX):
+        return None
+    return os.path.join(directory, name)
+
+
+def send(connection, source, name=None, **kwargs):
+    """ Starts sending a file (path) or a buffer, returns its Outgoing.
+
+    The keyword arguments are passed to Outgoing.
+    """
+    if name is None:
+        name = "buffer" if isinstance(
+            source, (bytes, bytearray, memoryview)) else \
+            os.path.basename(source)
+    outgoing = Outgoing(connection, name, source, **kwargs)
+    transfers = transfersOf(connection)
+    with transfers.lock:
+        outgoing.id = transfers.next_id
+        transfers.next_id += 1
+        transfers.outgoing[outgoing.id] = outgoing
+    outgoing.start()
+    return outgoing
+
+
+def cancelAll(connection):
+    """ Stops the transfers of a closed connection. """
+    if connection.transfers is None:
+        return
+    for transfer in connection.transfers.all():
+        transfer.finish("Disconnected.")
+
+
+def handleStart(client, data):
+    """ Transfer announced by the other side. """
+
+    # 0:0x03 Transfer Start
+    transfer_id, name, size = data
+    transfers = transfersOf(client)
+    sink = client.acceptTransfer(name, size) if size >= 0 else None
+    if sink is None:
+        logging.warning("Refused %s (%s bytes) from %s.",
+                        name, size, client.address)
+        client.pack(TRANSFER_ACK, [("VarInt", transfer_id), ("VarLong", -1)])
+        return
+    try:
+        incoming = Incoming(client, transfer_id, name, size, sink)
+    except OSError as e:
+        logging.warning("Refused %s from %s: %s", name, client.address, e)
+        client.pack(TRANSFER_ACK, [("VarInt", transfer_id), ("VarLong", -1)])
+        return
+    with transfers.lock:
+        transfers.incoming[transfer_id] = incoming
+    logging.info("Receiving %s (%s bytes) from %s, at %s.",
+                 name, size, client.address, incoming.offset)
+    incoming.start()
+
+
+def handleChunk(client, data):
+    """ Part of a transfer. """
+
+    # 0:0x04 Transfer Chunk
+    transfer_id, offset, chunk = data
+    incoming = None
+    if client.transfers is not None:
+        incoming = client.transfers.incoming.get(transfer_id)
+    if incoming is None:
+        logging.debug("Chunk of unknown transfer %s.", transfer_id)
+        return
+    incoming.chunk(offset, chunk)
+
+
+def handleAck(client, data):
+    """ Offset of a transfer taken by the other side. """
+
+    # 0:0x05 Transfer Ack
+    transfer_id, offset = data
+    outgoing = None
+    if client.transfers is not None:
+        outgoing = client.transfers.outgoing.get(transfer_id)
+    if outgoing is None:
+        logging.debug("Ack of unknown transfer %s.", transfer_id)
+        return
+    outgoing.acknowledged(offset)
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import multiprocessing
+import logging.handlers
+
+import commands.server
+
+SAMPLE_SIZE = 1024  # Bytes of the JSON sample of each worker
+STOP_TIMEOUT = 5  # s
+
+context = multiprocessing.get_context("fork")
+
+
+class SharedStatus:
+    """ Online clients of every worker process, in shared memory. """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.online = context.Array("i", workers, lock=False)
+        self.samples = context.Array("c", workers * SAMPLE_SIZE, lock=False)
+        self.version = context.Value("Q", 0)  # Its lock guards every field
+
+    def update(self, index, online, sample):
+        """ Publishes the clients of worker index. """
+        sample = list(sample)
+        data = json.dumps(sample).encode("utf-8")
+        while len(data) > SAMPLE_SIZE:  # Drops clients until it fits.
+            sample.pop()
+            data = json.dumps(sample).encode("utf-8")
+        data = data.ljust(SAMPLE_SIZE, b" ")
+
+        with self.version.get_lock():
+            self.online[index] = online
+            start = index * SAMPLE_SIZE
+            self.samples[start:start + SAMPLE_SIZE] = data
+            self.version.value += 1
+
+    def aggregate(self):
+        """ Returns the total of online clients and the merged samples. """
+        with self.version.get_lock():
+            online = sum(self.online)
+            samples = self.samples.raw
+        sample = []
+        for i in range(self.workers):
+            data = samples[i * SAMPLE_SIZE:(i + 1) * SAMPLE_SIZE]
+            data = data.rstrip(b" \x00")  # Padding or never updated
+            if data:
+                sample.extend(json.loads(data))
+        return online, sample
+
+
+class SharedStatusCache(commands.server.StatusCache):
+    """ Status response of a worker counting the clients of every worker. """
+
+    def __init__(self, propreties, shared, index, min_interval=0):
+        super().__init__(propreties, min_interval)
+        self.shared = shared
+        self.index = index
+
+    def invalidate(self):
+        clients = self.propreties["clients"]
+        self.shared.update(self.index, clients["online"], clients["sample"])
+        super().invalidate()
+
+    def currentVersion(self):
+        return self.version, self.shared.version.value
+
+    def status(self):
+        online, sample = self.shared.aggregate()
+        status = dict(self.propreties)
+        status["clients"] = dict(status["clients"],
+                                 online=online, sample=sample,
+                                 max=status["clients"]["max"]
+                                 * self.shared.workers)
+        return status
+
+
+class WorkerProcesses:
+    """ Forked server processes, receiving commands through pipes.
+
+    The records logged by the workers are handled by the parent process.
+    """
+
+    def __init__(self, count, target):
+        self.shared = SharedStatus(count)
+        self.log_queue = context.Queue()
+        self.listener = logging.handlers.QueueListener(
+            self.log_queue, *logging.getLogger().handlers,
+            respect_handler_level=True)
+        self.processes = []
+        self.pipes = []
+
+        for i in range(count):
+            parent_pipe, child_pipe = context.Pipe()
+            self.pipes.append(parent_pipe)
+            self.processes.append(context.Process(
+                target=self._run, name="Process-%s" % i,
+                args=(target, i, child_pipe)))
+
+    def start(self):
+        self.listener.start()
+        for p in self.processes:
+            p.start()
+
+    def command(self, text):
+        """ Sends a command to every running worker. """
+        for p, pipe in zip(self.processes, self.pipes):
+            if p.is_alive():
+                pipe.send(text)
+
+    def alive(self):
+        return any(p.is_alive() for p in self.processes)
+
+    def stop(self):
+        """ Stops the workers and waits for them. """
+        self.command("stop")
+        for p in self.processes:
+            p.join(STOP_TIMEOUT)
+            if p.is_alive():
+                logging.warning("Terminating %s.", p.name)
+                p.terminate()
+                p.join()
+        self.listener.stop()
+
+    def _run(self, target, index, pipe):
+        """ Entry point of a worker process. """
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(logging.handlers.QueueHandler(self.log_queue))
+
+        target(index, self.shared, pipe)